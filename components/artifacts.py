@@ -0,0 +1,156 @@
+import gzip
+from base64 import b64encode, urlsafe_b64encode
+from typing import Callable, Dict, List, NamedTuple, Optional
+from urllib.parse import quote, urlencode
+
+from components import redis
+from components.codec import dump_json, dump_yaml
+from components.template import digest
+
+try:
+    import brotli
+except ImportError:  # brotli 为可选依赖，未安装时只生成 gzip
+    brotli = None
+
+# 每次发布都写入一组新版本号下的 key，再切换 current 指针，旧版本的 key 自然过期
+ARTIFACT_KEY = "subscription:artifact:{}:{}"
+ARTIFACT_CURRENT_KEY = "subscription:artifact:current"
+ARTIFACT_NAMES = ("clash", "json", "uri", "proxies")
+ARTIFACT_USER_INFO = "user-info"
+SUBSCRIPTION_VERSION_KEY = "subscription:version"
+SUBSCRIPTION_CHANNEL = "subscription:published"
+USER_INFO_KEY = "subscription:user:info"
+
+
+class Artifact(NamedTuple):
+    name: str
+    content_type: str
+    body: bytes
+    gzip: bytes
+    br: Optional[bytes]
+    etag: str
+
+    @classmethod
+    def create(cls, name: str, content_type: str, body: bytes) -> "Artifact":
+        return cls(
+            name=name,
+            content_type=content_type,
+            body=body,
+            gzip=gzip.compress(body, compresslevel=9, mtime=0),
+            br=brotli.compress(body) if brotli is not None else None,
+            etag=f'"{digest(body)}"',
+        )
+
+    def dumps(self) -> Dict[str, bytes]:
+        # body 与 gzip 内容相同，只保存 gzip，加载时再解压，省去一份未压缩的副本
+        mapping = {
+            "content-type": self.content_type.encode(),
+            "gzip": self.gzip,
+            "etag": self.etag.encode(),
+        }
+        if self.br is not None:
+            mapping["br"] = self.br
+        return mapping
+
+    @classmethod
+    def loads(cls, name: str, mapping: Dict[bytes, bytes]) -> "Artifact":
+        return cls(
+            name=name,
+            content_type=mapping[b"content-type"].decode(),
+            body=redis.decode(mapping[b"body"]) if b"body" in mapping else gzip.decompress(mapping[b"gzip"]),
+            gzip=mapping[b"gzip"],
+            br=mapping.get(b"br"),
+            etag=mapping[b"etag"].decode(),
+        )
+
+
+def b64(value: str) -> str:
+    return b64encode(value.encode()).decode()
+
+
+def ss_uri(proxy: dict) -> str:
+    userinfo = urlsafe_b64encode(f"{proxy['cipher']}:{proxy['password']}".encode()).decode().rstrip("=")
+    return f"ss://{userinfo}@{proxy['server']}:{proxy['port']}#{quote(proxy['name'])}"
+
+
+def ssr_uri(proxy: dict) -> str:
+    main = ":".join(
+        [
+            str(proxy["server"]),
+            str(proxy["port"]),
+            proxy["protocol"],
+            proxy["cipher"],
+            proxy["obfs"],
+            urlsafe_b64encode(proxy["password"].encode()).decode().rstrip("="),
+        ]
+    )
+    params = {
+        "obfsparam": proxy.get("obfs-param", ""),
+        "protoparam": proxy.get("protocol-param", ""),
+        "remarks": proxy["name"],
+    }
+    query = "&".join(f"{key}={urlsafe_b64encode(value.encode()).decode().rstrip('=')}" for key, value in params.items())
+    return f"ssr://{urlsafe_b64encode(f'{main}/?{query}'.encode()).decode().rstrip('=')}"
+
+
+def vmess_uri(proxy: dict) -> str:
+    ws_opts = proxy.get("ws-opts") or {}
+    share = {
+        "v": "2",
+        "ps": proxy["name"],
+        "add": proxy["server"],
+        "port": str(proxy["port"]),
+        "id": proxy["uuid"],
+        "aid": str(proxy.get("alterId", 0)),
+        "scy": proxy.get("cipher", "auto"),
+        "net": proxy.get("network", "tcp"),
+        "type": "none",
+        "host": (ws_opts.get("headers") or {}).get("Host", ""),
+        "path": ws_opts.get("path", ""),
+        "tls": "tls" if proxy.get("tls") else "",
+        "sni": proxy.get("servername", ""),
+    }
+    return f"vmess://{b64encode(dump_json(share)).decode()}"
+
+
+def trojan_uri(proxy: dict) -> str:
+    params = {}
+    if proxy.get("sni"):
+        params["sni"] = proxy["sni"]
+    if proxy.get("skip-cert-verify"):
+        params["allowInsecure"] = "1"
+    query = f"?{urlencode(params)}" if params else ""
+    return f"trojan://{quote(proxy['password'])}@{proxy['server']}:{proxy['port']}{query}#{quote(proxy['name'])}"
+
+
+URI_RENDERERS: Dict[str, Callable[[dict], str]] = {
+    "ss": ss_uri,
+    "ssr": ssr_uri,
+    "vmess": vmess_uri,
+    "trojan": trojan_uri,
+}
+
+
+def proxy_uris(proxies: List[dict]) -> List[str]:
+    """转换成通用的分享链接，不支持的类型或缺少字段的节点会被跳过"""
+    uris = []
+    for proxy in proxies:
+        renderer = URI_RENDERERS.get(proxy.get("type"))
+        if renderer is None:
+            continue
+        try:
+            uris.append(renderer(proxy))
+        except KeyError:
+            continue
+    return uris
+
+
+def render_artifacts(clash: dict) -> Dict[str, Artifact]:
+    """由同一份已解析的配置一次生成所有格式的订阅，每种格式都预先压缩好"""
+    artifacts = [
+        Artifact.create("clash", "text/yaml; charset=utf-8", dump_yaml(clash).encode()),
+        Artifact.create("json", "application/json", dump_json(clash)),
+        Artifact.create("uri", "text/plain; charset=utf-8", b64("\n".join(proxy_uris(clash["proxies"]))).encode()),
+        Artifact.create("proxies", "text/yaml; charset=utf-8", dump_yaml({"proxies": clash["proxies"]}).encode()),
+    ]
+    return {artifact.name: artifact for artifact in artifacts}
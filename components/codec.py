@@ -0,0 +1,37 @@
+from typing import Any, Union
+
+import orjson
+import yaml
+from yaml import SafeDumper
+
+try:
+    from yaml import CSafeDumper
+    from yaml import CSafeLoader as SafeLoader
+
+    LIBYAML = True
+except ImportError:  # PyYAML 未编译 libyaml 扩展时回退到纯 Python 实现
+    from yaml import SafeDumper as CSafeDumper
+    from yaml import SafeLoader
+
+    LIBYAML = False
+
+
+def load_yaml(content: Union[str, bytes]) -> Any:
+    return yaml.load(content, Loader=SafeLoader)
+
+
+def dump_yaml(data: Any, allow_unicode: bool = True, width: int = 800, sort_keys: bool = False) -> str:
+    """libyaml 即使 allow_unicode 也会把 emoji 等 BMP 以外的字符转义成 \\U0001F1ED，
+    节点名与分组名都带 emoji，allow_unicode 时使用纯 Python 实现，保证输出与是否安装 libyaml 无关
+    """
+    dumper = SafeDumper if allow_unicode else CSafeDumper
+    return yaml.dump(data, Dumper=dumper, allow_unicode=allow_unicode, width=width, sort_keys=sort_keys)
+
+
+def load_json(content: Union[str, bytes]) -> Any:
+    return orjson.loads(content)
+
+
+def dump_json(data: Any) -> bytes:
+    """紧凑的 JSON，用于不需要 YAML 的内部数据"""
+    return orjson.dumps(data)
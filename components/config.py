@@ -2,9 +2,10 @@ import inspect
 from os import path
 from typing import Dict, Optional
 
-import yaml
 from aiofile import async_open
 
+from components.codec import load_yaml
+
 
 def get_real_path(cfg_file: str, base_file: Optional[str] = None) -> str:
     if not path.isabs(cfg_file):
@@ -19,12 +20,12 @@ def get_real_path(cfg_file: str, base_file: Optional[str] = None) -> str:
 
 async def async_load_yaml_config(cfg_file: str, base_file: Optional[str] = None) -> Dict:
     async with async_open(get_real_path(cfg_file, base_file), "r") as file:
-        cfg = yaml.load(await file.read(), Loader=yaml.FullLoader)
+        cfg = load_yaml(await file.read())
     return cfg
 
 
 def load_yaml_config(cfg_file: str, base_file: Optional[str] = None) -> Dict:
     cfg_file = get_real_path(cfg_file, base_file)
     with open(cfg_file, "r", encoding="utf-8") as file:
-        cfg = yaml.load(file.read(), Loader=yaml.FullLoader)
+        cfg = load_yaml(file.read())
     return cfg
@@ -0,0 +1,40 @@
+from asyncio import get_running_loop
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from time import perf_counter
+from typing import Any, Callable
+
+from loguru import logger
+
+from components.getsetter import GetSetTer
+from setting import ExecutorKind, setting
+
+pool = GetSetTer()
+
+
+async def register_executor():
+    cfg = setting.executor
+    if cfg.kind == ExecutorKind.process:
+        pool.val = ProcessPoolExecutor(max_workers=cfg.workers)
+    else:
+        pool.val = ThreadPoolExecutor(max_workers=cfg.workers, thread_name_prefix="codec")
+
+
+async def close_executor():
+    executor: Executor = pool.val
+    executor.shutdown(wait=True)
+
+
+async def run(func: Callable, *args, **kwargs) -> Any:
+    """在 codec 线程池/进程池中执行耗时的同步函数（如 YAML 的解析与序列化），避免阻塞调度器的事件循环
+
+    >>> config = await run(load_yaml, content)
+
+    使用进程池时 func 与参数需要能被 pickle
+    """
+    start = perf_counter()
+    try:
+        return await get_running_loop().run_in_executor(pool.val, partial(func, *args, **kwargs))
+    finally:
+        elapsed = perf_counter() - start
+        logger.info("{} took {:.3f}s in {} executor", func.__name__, elapsed, setting.executor.kind.value)
@@ -0,0 +1,182 @@
+import asyncio
+from os import getpid
+from socket import gethostname
+from time import monotonic
+from typing import Optional
+from uuid import uuid4
+
+from aioredis import Redis, WatchError
+from aioredis.client import Pipeline
+from apscheduler.schedulers.base import STATE_PAUSED, STATE_RUNNING, BaseScheduler
+from loguru import logger
+
+from components import redis
+from components.getsetter import GetSetTer
+from components.scheduler import trigger_job
+from setting import setting
+
+lease = GetSetTer()
+campaigner = GetSetTer()
+
+# 新 leader 本地的 config/clash.yaml 可能早已过期，接管后先重新生成配置，成功后会链式刷新订阅
+TAKEOVER_JOBS = ("refresh_clash_config",)
+
+
+class LeaseLostException(Exception):
+    pass
+
+
+class Lease:
+    """Redis 租约锁，每次取得租约时写入唯一的值，fencing 通过 WATCH 这个值实现，不使用递增的 token
+
+    >>> lease = Lease("e-schedule:leader", ttl=30)
+    >>> if await lease.acquire():
+    ...     async with rdb.pipeline(transaction=True) as pipe:
+    ...         await lease.fence(pipe)
+    ...         await pipe.set(key, value).execute()
+
+    租约在写入前已被其他实例取得时，fence 抛出 LeaseLostException，
+    在 fence 与 execute 之间被取得时，execute 抛出 WatchError，
+    Redis 之外的副作用（本地文件、HTTP 请求）无法与租约原子化，只能在执行前用 check 缩小旧 leader 的窗口
+    """
+
+    __slots__ = ("__key", "__ttl", "__client", "__identity", "__value", "__renewed_at")
+
+    def __init__(self, key: str, ttl: float, client: Optional[Redis] = None):
+        self.__key = key
+        self.__ttl = ttl
+        self.__client = client
+        self.__identity = f"{gethostname()}-{getpid()}"
+        self.__value: Optional[str] = None
+        self.__renewed_at = 0.0
+
+    @property
+    def rdb(self) -> Redis:
+        return self.__client if self.__client is not None else redis.client()
+
+    @property
+    def ttl(self) -> float:
+        return self.__ttl
+
+    @property
+    def held(self) -> bool:
+        return self.__value is not None
+
+    def valid(self, margin: float = 0) -> bool:
+        """最后一次成功续期后的 ttl - margin 秒内，即使暂时连不上 Redis，租约也不可能被其他实例取得"""
+        return self.held and monotonic() - self.__renewed_at + margin < self.__ttl
+
+    def lost(self):
+        self.__value = None
+
+    async def acquire(self) -> bool:
+        """已持有租约时续期，否则尝试取得租约"""
+        if self.held:
+            return await self.renew()
+
+        renewed_at = monotonic()
+        value = f"{self.__identity}:{uuid4().hex}"
+        if not await self.rdb.set(self.__key, value, nx=True, px=int(self.__ttl * 1000)):
+            return False
+
+        self.__value, self.__renewed_at = value, renewed_at
+        logger.info("lease {} acquired: {}", self.__key, value)
+        return True
+
+    async def renew(self) -> bool:
+        """租约的值仍是自己写入的值时续期，Redis 暂时不可用时的异常向上抛出，不会放弃租约"""
+        renewed_at = monotonic()
+        try:
+            async with self.rdb.pipeline(transaction=True) as pipe:
+                await self.fence(pipe)
+                await pipe.pexpire(self.__key, int(self.__ttl * 1000)).execute()
+            self.__renewed_at = renewed_at
+            return True
+        except (LeaseLostException, WatchError):
+            logger.warning("lease {} lost: {}", self.__key, self.__value)
+            self.lost()
+            return False
+
+    async def release(self):
+        if not self.held:
+            return
+
+        try:
+            async with self.rdb.pipeline(transaction=True) as pipe:
+                await self.fence(pipe)
+                await pipe.delete(self.__key).execute()
+        except (LeaseLostException, WatchError):
+            pass
+        finally:
+            self.lost()
+
+    def __verify(self, current: Optional[bytes]):
+        if self.__value is None or current is None or current.decode() != self.__value:
+            raise LeaseLostException(f"lease {self.__key} is not held by {self.__identity}")
+
+    async def fence(self, pipe: Pipeline):
+        """WATCH 租约并确认仍由自己持有，随后开启 MULTI，之后写入的命令只在租约未变化时才会执行"""
+        await pipe.watch(self.__key)
+        try:
+            self.__verify(await pipe.get(self.__key))
+        except LeaseLostException:
+            await pipe.reset()
+            raise
+        pipe.multi()
+
+    async def check(self):
+        """确认租约仍由自己持有，用于无法放进 MULTI/EXEC 的副作用，检查之后失去租约的情况无法避免"""
+        self.__verify(await self.rdb.get(self.__key))
+
+
+async def fence(pipe: Pipeline):
+    """未开启 leader 选举时不做任何检查"""
+    if lease.val is not None:
+        await lease.val.fence(pipe)
+
+
+async def check_leader():
+    """未开启 leader 选举时不做任何检查，失去租约时抛出 LeaseLostException"""
+    if lease.val is not None:
+        await lease.val.check()
+
+
+async def campaign(scheduler: BaseScheduler, current: Lease):
+    """持有租约时运行调度器，失去租约时暂停，standby 实例在租约过期后的一个检查周期内接管
+
+    访问 Redis 出错时保留本地的租约，下一轮按自己写入的值续期，租约在下一轮检查前可能过期时才暂停调度器
+    """
+    interval = current.ttl / 3
+    while True:
+        try:
+            held = await current.acquire()
+        except Exception as e:
+            logger.warning("lease campaign failed: {}", e)
+            held = current.valid(margin=interval)
+
+        if held and scheduler.state == STATE_PAUSED:
+            logger.info("became leader, resume scheduler")
+            scheduler.resume()
+            for job_id in TAKEOVER_JOBS:
+                trigger_job(job_id)
+        elif not held and scheduler.state == STATE_RUNNING:
+            logger.info("not leader, pause scheduler")
+            scheduler.pause()
+        await asyncio.sleep(interval)
+
+
+async def register_leader(scheduler: BaseScheduler):
+    cfg = setting.leader
+    if not cfg.enable:
+        return
+
+    lease.val = Lease(cfg.key, cfg.lease)
+    campaigner.val = asyncio.create_task(campaign(scheduler, lease.val))
+
+
+async def close_leader():
+    if lease.val is None:
+        return
+
+    campaigner.val.cancel()
+    await lease.val.release()
@@ -0,0 +1,105 @@
+import ssl
+from asyncio import Semaphore, TimeoutError, create_task, open_connection, wait, wait_for
+from time import perf_counter
+from typing import Dict, Iterable, Optional, Tuple
+
+from loguru import logger
+
+from components import redis
+from components.ranking import record_history
+from setting import setting
+
+Target = Tuple[str, int]
+
+PROBE_KEY = "proxy:probe:{}:{}"
+# 缓存中表示节点不可达的延迟值
+UNREACHABLE = -1
+
+
+def unverified_context() -> ssl.SSLContext:
+    """代理节点大多使用自签名证书，探测只关心握手能否完成"""
+    context = ssl.create_default_context()
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+async def probe(host: str, port: int, timeout: float, tls: bool = False) -> Optional[float]:
+    """TCP 连接（可选 TLS 握手）到 host:port，返回耗时，单位秒，不可达时返回 None
+
+    订阅中的 server / port 可能不合法（如超长的域名标签、非数字的端口），任何异常都视为不可达，不影响其他节点
+    """
+    start = perf_counter()
+    try:
+        _, writer = await wait_for(open_connection(host, port, ssl=unverified_context() if tls else None), timeout)
+    except (OSError, TimeoutError, ssl.SSLError):
+        return None
+    except Exception as e:
+        logger.warning("probe {}:{} failed: {!r}", host, port, e)
+        return None
+
+    latency = perf_counter() - start
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except (OSError, ssl.SSLError):
+        pass
+    return latency
+
+
+async def probe_all(
+    targets: Iterable[Target],
+    concurrency: int,
+    timeout: float,
+    deadline: float,
+    tls: bool = False,
+) -> Dict[Target, Optional[float]]:
+    """并发探测所有目标，同时进行的连接数不超过 concurrency，deadline 到期时仍未完成的目标视为不可达"""
+    semaphore = Semaphore(concurrency)
+
+    async def probe_with_limit(target: Target) -> Optional[float]:
+        async with semaphore:
+            return await probe(*target, timeout=timeout, tls=tls)
+
+    tasks = {target: create_task(probe_with_limit(target)) for target in set(targets)}
+    if not tasks:
+        return {}
+
+    _, pending = await wait(tasks.values(), timeout=deadline)
+    for task in pending:
+        task.cancel()
+    if pending:
+        logger.warning("{} probes did not finish before the deadline", len(pending))
+
+    return {
+        target: None if task in pending or task.cancelled() or task.exception() is not None else task.result()
+        for target, task in tasks.items()
+    }
+
+
+async def probe_proxies(targets: Iterable[Target]) -> Dict[Target, Optional[float]]:
+    """探测代理节点的 server:port，结果在 Redis 中缓存 setting.probe.cache_ttl 秒"""
+    cfg = setting.probe
+    targets = list(set(targets))
+    rdb = redis.client()
+
+    cached = await rdb.mget([PROBE_KEY.format(*target) for target in targets]) if targets else []
+    results: Dict[Target, Optional[float]] = {}
+    for target, value in zip(targets, cached):
+        if value is not None:
+            latency = float(value)
+            results[target] = None if latency == UNREACHABLE else latency
+
+    missing = [target for target in targets if target not in results]
+    if missing:
+        probed = await probe_all(missing, cfg.concurrency, cfg.timeout, cfg.deadline, cfg.tls)
+        async with rdb.pipeline(transaction=False) as pipe:
+            for target, latency in probed.items():
+                pipe.set(PROBE_KEY.format(*target), UNREACHABLE if latency is None else latency, ex=cfg.cache_ttl)
+            await pipe.execute()
+        await record_history(probed, targets)
+        results.update(probed)
+
+    unreachable = sum(latency is None for latency in results.values())
+    logger.info("probe {} proxies, {} cached, {} unreachable", len(results), len(results) - len(missing), unreachable)
+    return results
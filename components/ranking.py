@@ -0,0 +1,108 @@
+from math import inf
+from struct import calcsize, pack, unpack_from
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from components import redis
+from setting import setting
+
+Target = Tuple[str, int]
+
+HISTORY_KEY = "proxy:history"
+HISTORY_TTL = 7 * 24 * 3600
+HEADER = "<HH"
+# 样本以毫秒存为 uint16，LOSS 表示该次探测失败
+LOSS = 0xFFFF
+MAX_LATENCY = LOSS - 1
+
+
+class RingBuffer:
+    """固定容量的延迟样本环形缓冲区，序列化为 4 字节头（写入位置、样本数）加 capacity 个 uint16"""
+
+    __slots__ = ("__capacity", "__position", "__count", "__samples")
+
+    def __init__(self, capacity: int):
+        self.__capacity = capacity
+        self.__position = 0
+        self.__count = 0
+        self.__samples = [LOSS] * capacity
+
+    @classmethod
+    def loads(cls, data: Optional[bytes], capacity: int) -> "RingBuffer":
+        buffer = cls(capacity)
+        if not data:
+            return buffer
+
+        position, count = unpack_from(HEADER, data)
+        stored = (len(data) - calcsize(HEADER)) // 2
+        samples = unpack_from(f"<{stored}H", data, calcsize(HEADER))
+        # 按写入顺序回放，容量变化时只保留最新的样本
+        start = (position - count) % stored if stored else 0
+        for i in range(count):
+            buffer.append_sample(samples[(start + i) % stored])
+        return buffer
+
+    def dumps(self) -> bytes:
+        return pack(f"{HEADER}{self.__capacity}H", self.__position, self.__count, *self.__samples)
+
+    def append_sample(self, sample: int):
+        self.__samples[self.__position] = sample
+        self.__position = (self.__position + 1) % self.__capacity
+        self.__count = min(self.__count + 1, self.__capacity)
+
+    def append(self, latency: Optional[float]):
+        """追加一次探测结果，latency 单位秒，None 表示失败"""
+        self.append_sample(LOSS if latency is None else min(round(latency * 1000), MAX_LATENCY))
+
+    def samples(self) -> List[int]:
+        start = (self.__position - self.__count) % self.__capacity
+        return [self.__samples[(start + i) % self.__capacity] for i in range(self.__count)]
+
+    def score(self, loss_penalty: float) -> float:
+        """分数越低越好：成功样本的平均延迟按丢包率加权，没有成功样本时为 inf"""
+        samples = self.samples()
+        successes = [sample for sample in samples if sample != LOSS]
+        if not successes:
+            return inf
+        loss_ratio = 1 - len(successes) / len(samples)
+        return sum(successes) / len(successes) * (1 + loss_penalty * loss_ratio)
+
+
+def field(target: Target) -> str:
+    return "{}:{}".format(*target)
+
+
+async def record_history(probed: Dict[Target, Optional[float]], alive: Iterable[Target]):
+    """把本轮探测结果追加到各节点的历史中，并清理已不在订阅中的节点"""
+    capacity = setting.probe.history_size
+    rdb = redis.client()
+    fields = [field(target) for target in probed]
+    stored = await rdb.hmget(HISTORY_KEY, fields) if fields else []
+
+    mapping = {}
+    for (target, latency), data in zip(probed.items(), stored):
+        buffer = RingBuffer.loads(data, capacity)
+        buffer.append(latency)
+        mapping[field(target)] = buffer.dumps()
+
+    alive_fields = {field(target) for target in alive}
+    stale = [key for key in await rdb.hkeys(HISTORY_KEY) if key.decode() not in alive_fields]
+    async with rdb.pipeline(transaction=True) as pipe:
+        if mapping:
+            pipe.hset(HISTORY_KEY, mapping=mapping)
+        if stale:
+            pipe.hdel(HISTORY_KEY, *stale)
+        await pipe.expire(HISTORY_KEY, HISTORY_TTL).execute()
+
+
+async def load_scores(targets: Iterable[Target]) -> Dict[Target, float]:
+    targets = list(targets)
+    if not targets:
+        return {}
+
+    capacity = setting.probe.history_size
+    stored = await redis.client().hmget(HISTORY_KEY, [field(target) for target in targets])
+    return {
+        target: RingBuffer.loads(data, capacity).score(setting.probe.loss_penalty)
+        for target, data in zip(targets, stored)
+        if data
+    }
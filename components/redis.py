@@ -1,10 +1,24 @@
+import zlib
+from typing import Any, Optional
+
 from aioredis import Redis, from_url
+from loguru import logger
 
 from components.getsetter import GetSetTer
 from setting import setting
 
+try:
+    import zstandard
+except ImportError:  # zstandard 为可选依赖，未安装时使用 zlib
+    zstandard = None
+
 pool = GetSetTer()
 
+# 压缩后的值以 MAGIC + 算法标记开头，未压缩的值原样保存，读取时两者都能识别
+MAGIC = b"\x1fES"
+ZLIB = b"z"
+ZSTD = b"s"
+
 
 async def register_redis():
     pool.val = await from_url(
@@ -16,3 +30,65 @@ async def register_redis():
 
 def client() -> Redis:
     return pool.val
+
+
+def compressed() -> "CompressedRedis":
+    return CompressedRedis(pool.val)
+
+
+def encode(value: bytes, public: bool = False) -> bytes:
+    """大于 compress_threshold 的值压缩后加上头部，public 表示外部服务也会直接读取该 key"""
+    cfg = setting.redis
+    if not cfg.compress or (public and not cfg.compress_public) or len(value) < cfg.compress_threshold:
+        return value
+
+    if zstandard is not None:
+        level = cfg.compress_level if cfg.compress_level is not None else 3
+        compressed = MAGIC + ZSTD + zstandard.ZstdCompressor(level=level).compress(value)
+    else:
+        level = cfg.compress_level if cfg.compress_level is not None else 6
+        compressed = MAGIC + ZLIB + zlib.compress(value, level)
+
+    if len(compressed) >= len(value):
+        return value
+    logger.debug("redis value compressed, {} -> {} bytes", len(value), len(compressed))
+    return compressed
+
+
+def decode(value: Optional[bytes]) -> Optional[bytes]:
+    if value is None or not value.startswith(MAGIC):
+        return value
+
+    codec, payload = value[len(MAGIC) : len(MAGIC) + 1], value[len(MAGIC) + 1 :]
+    if codec == ZLIB:
+        return zlib.decompress(payload)
+    if codec == ZSTD:
+        if zstandard is None:
+            raise RuntimeError("redis 中的值使用 zstd 压缩，需要安装 zstandard")
+        return zstandard.ZstdDecompressor().decompress(payload)
+    raise ValueError(f"未知的 redis 压缩格式 -> {codec!r}")
+
+
+class CompressedRedis:
+    """client() 的包装，get 透明解压、set 按 encode 的规则压缩，其余命令原样转发
+
+    外部服务直接读取的 key（subscription:clash、rule-provider）以 public=True 写入，默认不压缩，
+    开启 compress_public 前读取方需先改用 compressed().get 或对读到的值调用 decode
+
+    >>> await redis.compressed().set("subscription:rule-provider:xxx", content, public=True, ex=86400)
+    >>> content = await redis.compressed().get("subscription:rule-provider:xxx")
+    """
+
+    __slots__ = ("__client",)
+
+    def __init__(self, rdb: Redis):
+        self.__client = rdb
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.__client, name)
+
+    async def get(self, name: str) -> Optional[bytes]:
+        return decode(await self.__client.get(name))
+
+    async def set(self, name: str, value: bytes, *, public: bool = False, **kwargs) -> Any:
+        return await self.__client.set(name, encode(value, public), **kwargs)
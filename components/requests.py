@@ -1,17 +1,41 @@
+import asyncio
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from enum import unique
+from hashlib import sha1
+from http import HTTPStatus
 from http.cookies import SimpleCookie
-from typing import Mapping, Optional, Union
+from itertools import cycle
+from time import monotonic
+from types import SimpleNamespace
+from typing import AsyncIterator, BinaryIO, Dict, List, Mapping, Optional, Tuple, Union
 from uuid import UUID, uuid4
 
-import orjson
-from aiohttp import ClientResponse, ClientSession, ClientTimeout, TCPConnector
+import charset_normalizer
+from aiofile import async_open
+from aiohttp import (
+    ClientError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    DummyCookieJar,
+    TCPConnector,
+    TraceConfig,
+    hdrs,
+)
+from aiohttp.tracing import TraceConnectionCreateEndParams, TraceConnectionReuseconnParams, TraceRequestStartParams
 from aiohttp.typedefs import LooseCookies, LooseHeaders
 from loguru import logger
-from multidict import CIMultiDictProxy
+from multidict import CIMultiDict, CIMultiDictProxy
 from yarl import URL
 
+from components import redis
+from components.codec import dump_json, load_json
 from components.enum import StrEnum
 from components.getsetter import GetSetTer
+from components.retry import NoRetryException
+from setting import setting
 
 pool = GetSetTer()
 
@@ -26,6 +50,20 @@ class Method(StrEnum):
 
 
 class Response:
+    """只持有原始 bytes，text 在首次访问时才解码并缓存，json 直接从 bytes 解析"""
+
+    __slots__ = (
+        "__r_id",
+        "__url",
+        "__status_code",
+        "__headers",
+        "__cookies",
+        "__content",
+        "__encoding",
+        "__text",
+        "__from_cache",
+    )
+
     def __init__(
         self,
         r_id: UUID,
@@ -34,7 +72,8 @@ class Response:
         headers: CIMultiDictProxy[str],
         cookies: SimpleCookie,
         content: bytes,
-        text: str,
+        encoding: Optional[str] = None,
+        from_cache: bool = False,
     ):
         self.__r_id = r_id
         self.__url: URL = url
@@ -42,7 +81,9 @@ class Response:
         self.__headers = headers
         self.__cookies = cookies
         self.__content = content
-        self.__text: str = text
+        self.__encoding = encoding
+        self.__text: Optional[str] = None
+        self.__from_cache = from_cache
 
     def __str__(self):
         return self.__repr__()
@@ -68,6 +109,10 @@ class Response:
     def ok(self) -> bool:
         return self.status_code < 400
 
+    def raise_for_status(self, msg: str):
+        if not self.ok:
+            raise HTTPStatusException(f"{msg}, {self.status_code}", self.status_code, retry_after(self.headers))
+
     @property
     def status_code(self) -> int:
         return self.__status_code
@@ -84,19 +129,441 @@ class Response:
     def content(self) -> bytes:
         return self.__content
 
+    @property
+    def from_cache(self) -> bool:
+        """上游返回 304，body 来自 HTTP 缓存"""
+        return self.__from_cache
+
     @property
     def text(self) -> str:
+        if self.__text is None:
+            self.__text = self.__decode()
         return self.__text
 
+    def __decode(self) -> str:
+        if self.__encoding is not None:
+            return self.__content.decode(self.__encoding, errors="replace")
+        try:
+            return self.__content.decode("utf-8")
+        except UnicodeDecodeError:
+            self.__encoding = charset_normalizer.detect(self.__content)["encoding"] or "utf-8"
+            return self.__content.decode(self.__encoding, errors="replace")
+
     def json(self) -> Union[list, dict]:
-        return orjson.loads(self.text)
+        return load_json(self.__content)
+
+
+class HTTPStatusException(Exception):
+    """响应状态码表示失败，retry 根据 status_code 判断是否重试，并在 retry_after 秒后才重试"""
+
+    def __init__(self, msg: str, status_code: int, retry_after: Optional[float] = None):
+        super().__init__(msg)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class BodyTooLargeException(NoRetryException):
+    def __init__(self, url: URL, max_size: int):
+        self.url = url
+        self.max_size = max_size
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return f"response body of {self.url} exceeds {self.max_size} bytes"
+
+
+class StreamResponse:
+    """流式响应，body 按块读取，不在内存中缓存完整内容"""
+
+    __slots__ = ("__r_id", "__response", "__max_size", "__chunk_size", "__received")
+
+    def __init__(self, r_id: UUID, response: ClientResponse, max_size: Optional[int], chunk_size: int):
+        self.__r_id = r_id
+        self.__response = response
+        self.__max_size = max_size
+        self.__chunk_size = chunk_size
+        self.__received = 0
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return f"<StreamResponse({self.r_id}) [{self.status_code}]>"
+
+    def __bool__(self):
+        return self.ok
+
+    @property
+    def r_id(self) -> UUID:
+        return self.__r_id
+
+    @property
+    def url(self) -> URL:
+        return self.__response.url
+
+    @property
+    def ok(self) -> bool:
+        return self.status_code < 400
+
+    @property
+    def status_code(self) -> int:
+        return self.__response.status
+
+    @property
+    def headers(self) -> CIMultiDictProxy[str]:
+        return self.__response.headers
+
+    @property
+    def cookies(self) -> SimpleCookie:
+        return self.__response.cookies
+
+    @property
+    def received(self) -> int:
+        """已读取的 body 字节数"""
+        return self.__received
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        content_length = self.__response.content_length
+        if self.__max_size is not None and content_length is not None and content_length > self.__max_size:
+            raise BodyTooLargeException(self.url, self.__max_size)
+
+        async for chunk in self.__response.content.iter_chunked(self.__chunk_size):
+            self.__received += len(chunk)
+            if self.__max_size is not None and self.__received > self.__max_size:
+                raise BodyTooLargeException(self.url, self.__max_size)
+            yield chunk
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    async def write_to(self, fp: Union[str, BinaryIO]) -> int:
+        """把 body 逐块写入文件路径或二进制 buffer，返回写入的字节数"""
+        if isinstance(fp, str):
+            async with async_open(fp, "wb") as file:
+                async for chunk in self.iter_chunks():
+                    await file.write(chunk)
+        else:
+            async for chunk in self.iter_chunks():
+                fp.write(chunk)
+        return self.__received
+
+
+# 304 响应中这些头部描述的是空 body，不能覆盖缓存的头部
+NOT_REVALIDATED_HEADERS = {
+    hdrs.CONTENT_LENGTH.lower(),
+    hdrs.CONTENT_ENCODING.lower(),
+    hdrs.TRANSFER_ENCODING.lower(),
+    hdrs.CONTENT_TYPE.lower(),
+}
+
+
+class CachedResponse:
+    """Redis 中缓存的响应，保存校验器（ETag / Last-Modified）、响应头与 body"""
+
+    __slots__ = ("etag", "last_modified", "headers", "content", "encoding")
+
+    def __init__(
+        self,
+        etag: Optional[str],
+        last_modified: Optional[str],
+        headers: List[Tuple[str, str]],
+        content: bytes,
+        encoding: Optional[str],
+    ):
+        self.etag = etag
+        self.last_modified = last_modified
+        self.headers = headers
+        self.content = content
+        self.encoding = encoding
+
+    @classmethod
+    def loads(cls, mapping: Dict[bytes, bytes]) -> "CachedResponse":
+        def field(name: bytes) -> Optional[str]:
+            value = mapping.get(name)
+            return value.decode() if value else None
+
+        return cls(
+            etag=field(b"etag"),
+            last_modified=field(b"last-modified"),
+            headers=[tuple(pair) for pair in load_json(mapping[b"headers"])],
+            content=redis.decode(mapping[b"body"]),
+            encoding=field(b"encoding"),
+        )
+
+    def dumps(self) -> Dict[str, Union[str, bytes]]:
+        return {
+            "etag": self.etag or "",
+            "last-modified": self.last_modified or "",
+            "headers": dump_json(self.headers),
+            "body": redis.encode(self.content),
+            "encoding": self.encoding or "",
+        }
+
+    def conditional_headers(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers[hdrs.IF_NONE_MATCH] = self.etag
+        if self.last_modified:
+            headers[hdrs.IF_MODIFIED_SINCE] = self.last_modified
+        return headers
+
+    def revalidate(self, headers: CIMultiDictProxy[str]) -> CIMultiDictProxy[str]:
+        """用 304 响应中的头部更新缓存的头部与校验器"""
+        merged = CIMultiDict(self.headers)
+        for key in {key.lower() for key in headers.keys()} - NOT_REVALIDATED_HEADERS:
+            merged.popall(key, None)
+            merged.extend((key, value) for value in headers.getall(key))
+        self.headers = list(merged.items())
+        self.etag = merged.get(hdrs.ETAG)
+        self.last_modified = merged.get(hdrs.LAST_MODIFIED)
+        return CIMultiDictProxy(merged)
+
+
+def http_cache_key(method: str, url: str, params: Optional[Mapping[str, str]]) -> str:
+    full_url = URL(url).update_query(params) if params else URL(url)
+    return f"http:cache:{sha1(f'{method} {full_url}'.encode()).hexdigest()}"
+
+
+async def load_http_cache(key: str) -> Optional[CachedResponse]:
+    mapping = await redis.client().hgetall(key)
+    if not mapping or b"body" not in mapping:
+        return None
+    return CachedResponse.loads(mapping)
+
+
+async def save_http_cache(key: str, cached: CachedResponse):
+    rdb = redis.client()
+    async with rdb.pipeline(transaction=True) as pipe:
+        await pipe.delete(key).hset(key, mapping=cached.dumps()).expire(key, setting.requests.http_cache_ttl).execute()
+
+
+async def touch_http_cache(key: str, cached: CachedResponse):
+    rdb = redis.client()
+    async with rdb.pipeline(transaction=True) as pipe:
+        await pipe.hset(
+            key,
+            mapping={
+                "etag": cached.etag or "",
+                "last-modified": cached.last_modified or "",
+                "headers": dump_json(cached.headers),
+            },
+        ).expire(key, setting.requests.http_cache_ttl).execute()
+
+
+def retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    """Retry-After 要求的等待时间，单位秒，支持秒数与 HTTP 日期两种格式，已经过去的日期视为 0"""
+    value = headers.get(hdrs.RETRY_AFTER, "").strip()
+    if value.isdigit():
+        return float(value)
+    if value:
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+        except (TypeError, ValueError):
+            logger.warning("invalid Retry-After: {}", value)
+    return None
+
+
+def poll_after(headers: Mapping[str, str]) -> Optional[float]:
+    """上游通过 Retry-After 或 Cache-Control 的 max-age 要求的最短轮询间隔，单位秒"""
+    hint = retry_after(headers)
+    hints: List[float] = [] if hint is None else [hint]
+    for directive in headers.get(hdrs.CACHE_CONTROL, "").split(","):
+        name, _, value = directive.strip().partition("=")
+        if name.lower() == "max-age" and value.strip('"').isdigit():
+            hints.append(float(value.strip('"')))
+
+    return max(hints) if hints else None
+
+
+class ConnectionStats:
+    """连接复用计数，用于观察长连接的效果"""
+
+    def __init__(self):
+        self.requests = 0
+        self.created = 0
+        self.reused = 0
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return f"<ConnectionStats requests={self.requests} created={self.created} reused={self.reused}>"
+
+    @property
+    def reuse_ratio(self) -> float:
+        total = self.created + self.reused
+        return self.reused / total if total else 0.0
+
+
+stats = ConnectionStats()
+
+
+@unique
+class CircuitState(StrEnum):
+    closed = "closed"
+    open = "open"
+    half_open = "half-open"
+
+
+class CircuitOpenException(NoRetryException):
+    """熔断器打开时直接失败，不发出请求，retry 也不会重试"""
+
+    def __init__(self, host: str, retry_in: float):
+        self.host = host
+        self.retry_in = retry_in
+
+    def __str__(self):
+        return self.__repr__()
+
+    def __repr__(self):
+        return f"circuit of {self.host} is open, retry in {self.retry_in:.0f}s"
+
+
+class CircuitBreaker:
+    """按 host 统计连续失败，连接错误、超时与 5xx 视为失败
+
+    closed: 正常请求，连续失败达到 breaker_threshold 次后打开
+    open: 直接抛出 CircuitOpenException，breaker_timeout 秒后进入 half-open
+    half-open: 只放行 breaker_half_open_calls 个探测请求，成功则关闭，失败则重新打开
+    """
+
+    __slots__ = ("host", "state", "failures", "opened_at", "probing")
+
+    def __init__(self, host: str):
+        self.host = host
+        self.state = CircuitState.closed
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = 0
+
+    def before(self) -> bool:
+        """请求前检查熔断状态，返回是否占用了 half-open 的探测名额，占用时请求结束后需要调用 done 归还"""
+        cfg = setting.requests
+        if self.state == CircuitState.open:
+            elapsed = monotonic() - self.opened_at
+            if elapsed < cfg.breaker_timeout:
+                raise CircuitOpenException(self.host, cfg.breaker_timeout - elapsed)
+            self.transit(CircuitState.half_open)
+
+        if self.state == CircuitState.half_open:
+            if self.probing >= cfg.breaker_half_open_calls:
+                raise CircuitOpenException(self.host, 0)
+            self.probing += 1
+            return True
+        return False
+
+    def done(self):
+        self.probing = max(self.probing - 1, 0)
+
+    def record(self, status: int):
+        if status >= HTTPStatus.INTERNAL_SERVER_ERROR:
+            self.failure()
+        else:
+            self.success()
+
+    def success(self):
+        self.failures = 0
+        if self.state != CircuitState.closed:
+            self.transit(CircuitState.closed)
+
+    def failure(self):
+        self.failures += 1
+        if self.state == CircuitState.half_open or self.failures >= setting.requests.breaker_threshold:
+            self.opened_at = monotonic()
+            if self.state != CircuitState.open:
+                self.transit(CircuitState.open)
+
+    def transit(self, state: CircuitState):
+        logger.warning("circuit of {} {} -> {}, failures: {}", self.host, self.state.value, state.value, self.failures)
+        self.state = state
+
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+
+@asynccontextmanager
+async def guard(url: Union[str, URL]) -> AsyncIterator[Optional[CircuitBreaker]]:
+    """请求前检查 host 的熔断器，请求出现连接错误或超时时记为失败，响应的状态码由调用方记录"""
+    host = URL(url).host
+    if setting.requests.breaker_threshold <= 0 or not host:
+        yield None
+        return
+
+    breaker = breakers.setdefault(host, CircuitBreaker(host))
+    probe = breaker.before()
+    try:
+        yield breaker
+    except (ClientError, asyncio.TimeoutError):
+        breaker.failure()
+        raise
+    finally:
+        if probe:
+            breaker.done()
+
+
+class SessionPool:
+    """启动时创建的一组长连接 ClientSession，共享同一个 TCPConnector，按轮询分配给请求"""
+
+    def __init__(self, connector: TCPConnector, sessions: List[ClientSession]):
+        self.__connector = connector
+        self.__sessions = sessions
+        self.__cycle = cycle(sessions)
+
+    @property
+    def connector(self) -> TCPConnector:
+        return self.__connector
+
+    def session(self) -> ClientSession:
+        return next(self.__cycle)
+
+    async def close(self):
+        for session in self.__sessions:
+            await session.close()
+        await self.__connector.close()
+
+
+async def on_request_start(_: ClientSession, __: SimpleNamespace, ___: TraceRequestStartParams):
+    stats.requests += 1
+
+
+async def on_connection_create_end(_: ClientSession, __: SimpleNamespace, ___: TraceConnectionCreateEndParams):
+    stats.created += 1
+
+
+async def on_connection_reuseconn(_: ClientSession, __: SimpleNamespace, ___: TraceConnectionReuseconnParams):
+    stats.reused += 1
 
 
 async def register_requests():
-    pool.val = TCPConnector(limit_per_host=3, keepalive_timeout=15)
+    cfg = setting.requests
+    trace_config = TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+
+    connector = TCPConnector(
+        limit=cfg.limit,
+        limit_per_host=cfg.limit_per_host,
+        keepalive_timeout=cfg.keepalive_timeout,
+    )
+    timeout = ClientTimeout(total=cfg.timeout, sock_connect=cfg.connect_timeout)
+    sessions = [
+        ClientSession(
+            connector=connector,
+            connector_owner=False,
+            timeout=timeout,
+            cookie_jar=DummyCookieJar(),
+            trace_configs=[trace_config],
+        )
+        for _ in range(max(cfg.sessions, 1))
+    ]
+    pool.val = SessionPool(connector, sessions)
 
 
 async def close_requests():
+    logger.info("requests closed, {}, reuse ratio: {:.2%}", stats, stats.reuse_ratio)
     await pool.val.close()
 
 
@@ -108,40 +575,81 @@ async def request(
     json: Optional[dict] = None,
     headers: Optional[LooseHeaders] = None,
     cookies: Optional[LooseCookies] = None,
+    cache: bool = False,
     *args,
     **kwargs,
 ) -> Response:
+    """发起请求
+
+    :param cache: 开启 HTTP 条件请求缓存，仅对 GET 生效。响应的 ETag / Last-Modified 与 body 存入 Redis，
+        之后的请求带上 If-None-Match / If-Modified-Since，上游返回 304 时直接使用缓存的 body
+    """
     r_id = uuid4()
     logger.info("{} request({}), url: {}, params: {}, data: {}, json: {}", method, r_id, url, params, data, json)
-    async with ClientSession(connector=pool.val, timeout=ClientTimeout(total=30), connector_owner=False) as session:
-        async with getattr(session, method)(
-            url,
-            params=params,
-            data=data,
-            json=json,
-            headers=headers,
-            cookies=cookies,
-            *args,
-            **kwargs,
-        ) as response:
-            response: ClientResponse
-            content = await response.read()
-            text = await response.text()
-
-            rsp = Response(
+
+    cache_key, cached = None, None
+    if cache and method == Method.get:
+        cache_key = http_cache_key(method, url, params)
+        cached = await load_http_cache(cache_key)
+        if cached is not None:
+            headers = CIMultiDict(headers or {})
+            headers.update(cached.conditional_headers())
+
+    session: ClientSession = pool.val.session()
+    async with guard(url) as breaker, getattr(session, method)(
+        url,
+        params=params,
+        data=data,
+        json=json,
+        headers=headers,
+        cookies=cookies,
+        *args,
+        **kwargs,
+    ) as response:
+        response: ClientResponse
+        if breaker is not None:
+            breaker.record(response.status)
+        if cached is not None and response.status == HTTPStatus.NOT_MODIFIED:
+            logger.info("request({}) not modified, use http cache", r_id)
+            rsp_headers = cached.revalidate(response.headers)
+            await touch_http_cache(cache_key, cached)
+            return Response(
                 r_id=r_id,
                 url=response.url,
-                status_code=response.status,
-                headers=response.headers,
+                status_code=HTTPStatus.OK,
+                headers=rsp_headers,
                 cookies=response.cookies,
-                content=content,
-                text=text,
+                content=cached.content,
+                encoding=cached.encoding,
+                from_cache=True,
             )
 
-            if not rsp.ok:
-                logger.warning("{}, text: {}", rsp, rsp.text)
+        body = StreamResponse(r_id, response, setting.requests.max_body_size, setting.requests.chunk_size)
+        rsp = Response(
+            r_id=r_id,
+            url=response.url,
+            status_code=response.status,
+            headers=response.headers,
+            cookies=response.cookies,
+            content=await body.read(),
+            encoding=response.charset,
+        )
+
+        if not rsp.ok:
+            logger.warning("{}, text: {}", rsp, rsp.text)
+        elif cache_key is not None and (hdrs.ETAG in rsp.headers or hdrs.LAST_MODIFIED in rsp.headers):
+            await save_http_cache(
+                cache_key,
+                CachedResponse(
+                    etag=rsp.headers.get(hdrs.ETAG),
+                    last_modified=rsp.headers.get(hdrs.LAST_MODIFIED),
+                    headers=list(rsp.headers.items()),
+                    content=rsp.content,
+                    encoding=response.charset,
+                ),
+            )
 
-            return rsp
+        return rsp
 
 
 # noinspection DuplicatedCode
@@ -152,6 +660,7 @@ async def get(
     json: Optional[dict] = None,
     headers: Optional[LooseHeaders] = None,
     cookies: Optional[LooseCookies] = None,
+    cache: bool = False,
     *args,
     **kwargs,
 ) -> Response:
@@ -163,6 +672,7 @@ async def get(
         json=json,
         headers=headers,
         cookies=cookies,
+        cache=cache,
         *args,
         **kwargs,
     )
@@ -262,3 +772,91 @@ async def delete(
         *args,
         **kwargs,
     )
+
+
+@asynccontextmanager
+async def stream(
+    method: str,
+    url: str,
+    params: Optional[Mapping[str, str]] = None,
+    data: Optional[dict] = None,
+    json: Optional[dict] = None,
+    headers: Optional[LooseHeaders] = None,
+    cookies: Optional[LooseCookies] = None,
+    max_size: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    *args,
+    **kwargs,
+) -> AsyncIterator[StreamResponse]:
+    """以流式读取响应 body，适合体积较大的下载
+
+    >>> async with stream(Method.get, url, max_size=1024) as rsp:
+    >>>     async for chunk in rsp.iter_chunks():
+    >>>         ...
+
+    :param max_size: body 最大字节数，超过时抛出 BodyTooLargeException，默认取 setting.requests.max_body_size
+    :param chunk_size: 每次读取的块大小，默认取 setting.requests.chunk_size
+    """
+    r_id = uuid4()
+    logger.info("{} stream({}), url: {}, params: {}", method, r_id, url, params)
+    session: ClientSession = pool.val.session()
+    async with guard(url) as breaker, getattr(session, method)(
+        url,
+        params=params,
+        data=data,
+        json=json,
+        headers=headers,
+        cookies=cookies,
+        *args,
+        **kwargs,
+    ) as response:
+        if breaker is not None:
+            breaker.record(response.status)
+        rsp = StreamResponse(
+            r_id,
+            response,
+            setting.requests.max_body_size if max_size is None else max_size,
+            chunk_size or setting.requests.chunk_size,
+        )
+        if not rsp.ok:
+            logger.warning("{}", rsp)
+        yield rsp
+
+
+# noinspection DuplicatedCode
+def stream_get(
+    url: str,
+    params: Optional[Mapping[str, str]] = None,
+    headers: Optional[LooseHeaders] = None,
+    cookies: Optional[LooseCookies] = None,
+    max_size: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    *args,
+    **kwargs,
+):
+    return stream(
+        Method.get,
+        url,
+        params=params,
+        headers=headers,
+        cookies=cookies,
+        max_size=max_size,
+        chunk_size=chunk_size,
+        *args,
+        **kwargs,
+    )
+
+
+async def download(
+    url: str,
+    fp: Union[str, BinaryIO],
+    params: Optional[Mapping[str, str]] = None,
+    headers: Optional[LooseHeaders] = None,
+    max_size: Optional[int] = None,
+    *args,
+    **kwargs,
+) -> int:
+    """把 GET 响应 body 直接写入文件路径或二进制 buffer，返回写入的字节数"""
+    async with stream_get(url, params=params, headers=headers, max_size=max_size, *args, **kwargs) as rsp:
+        assert rsp.ok, f"下载失败, {rsp.status_code}"
+        return await rsp.write_to(fp)
@@ -1,10 +1,14 @@
 from asyncio import sleep
 from functools import wraps
-from traceback import format_exc
-from typing import Callable, List, Union
+from random import uniform
+from time import monotonic
+from typing import Callable, Collection, List, Optional, Tuple, Union
 
 from loguru import logger
 
+# 默认重试的 HTTP 状态码，其余 4xx 重试也不会成功
+RETRYABLE_STATUS = frozenset({408, 425, 429, 500, 502, 503, 504})
+
 
 class MaxRetriesException(BaseException):
     def __init__(self, func: Callable, retries: int, errors: List[BaseException]):
@@ -12,6 +16,11 @@ class MaxRetriesException(BaseException):
         self.retries = retries
         self.errors = errors
 
+    @property
+    def retry_after(self) -> Optional[float]:
+        """最后一次失败时上游通过 Retry-After 要求的等待时间"""
+        return getattr(self.errors[-1], "retry_after", None) if self.errors else None
+
     def __str__(self):
         return self.__repr__()
 
@@ -19,45 +28,223 @@ class MaxRetriesException(BaseException):
         return f"{self.func.__name__} has been retried {self.retries} times\n\n{display_errors(self.errors)}"
 
 
+class NoRetryException(Exception):
+    """重试没有意义的异常（如熔断器打开时的快速失败），抛出后不再重试"""
+
+
 def display_errors(errors: List[BaseException]) -> str:
     return "\n".join(str(e) for e in errors)
 
 
-def retry(retries: int = 5, delay: Union[int, float] = 0, step: Union[int, float] = 0):
-    """函数执行出现异常时自动重试的简单装饰器
+class RetryBudget:
+    """重试预算，避免上游故障时重试成倍放大请求量，默认每个被 retry 装饰的函数各用一个，互不影响
+
+    每次调用存入 ratio 个令牌，每秒另外存入 per_second 个令牌，每次重试取出一个，令牌不足时不再重试
+    """
+
+    __slots__ = ("__ratio", "__per_second", "__capacity", "__tokens", "__updated")
+
+    def __init__(self, ratio: float = 0.2, per_second: float = 0.1, capacity: float = 10):
+        self.__ratio = ratio
+        self.__per_second = per_second
+        self.__capacity = capacity
+        self.__tokens = capacity
+        self.__updated = monotonic()
+
+    @property
+    def tokens(self) -> float:
+        self.__refill(0)
+        return self.__tokens
+
+    def __refill(self, amount: float):
+        now = monotonic()
+        elapsed, self.__updated = now - self.__updated, now
+        self.__tokens = min(self.__capacity, self.__tokens + amount + elapsed * self.__per_second)
+
+    def deposit(self):
+        self.__refill(self.__ratio)
+
+    def withdraw(self) -> bool:
+        self.__refill(0)
+        if self.__tokens < 1:
+            return False
+        self.__tokens -= 1
+        return True
+
+
+class Backoff:
+    """单次调用内的重试延迟，第 n 次重试的延迟为 delay * factor ** n + step * n，jitter 时在 [0, 延迟] 内随机"""
+
+    __slots__ = ("delay", "step", "factor", "max_delay", "jitter", "attempts")
+
+    def __init__(
+        self,
+        delay: float,
+        step: float = 0,
+        factor: float = 1,
+        max_delay: Optional[float] = None,
+        jitter: bool = False,
+    ):
+        self.delay = delay
+        self.step = step
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.attempts = 0
+
+    def next(self) -> float:
+        wait = self.delay * self.factor**self.attempts + self.step * self.attempts
+        self.attempts += 1
+        if self.max_delay is not None:
+            wait = min(wait, self.max_delay)
+        return uniform(0, wait) if self.jitter else wait
+
+
+def retryable(
+    err: BaseException,
+    retry_on: Optional[Callable[[BaseException], bool]] = None,
+    statuses: Collection[int] = RETRYABLE_STATUS,
+) -> bool:
+    """CancelledError 等非 Exception 与 NoRetryException 从不重试，带 status_code 的异常只重试 statuses 中的状态码"""
+    if not isinstance(err, Exception) or isinstance(err, NoRetryException):
+        return False
+    status = getattr(err, "status_code", None)
+    if status is not None and status not in statuses:
+        return False
+    return retry_on is None or retry_on(err)
+
+
+class RetryPolicy:
+    """retry 装饰器的配置，每次调用通过 start 得到独立的延迟与截止时间"""
+
+    __slots__ = (
+        "retries",
+        "delay",
+        "step",
+        "factor",
+        "max_delay",
+        "jitter",
+        "deadline",
+        "retry_on",
+        "statuses",
+        "budget",
+    )
+
+    def __init__(
+        self,
+        retries: int,
+        delay: float,
+        step: float,
+        factor: float,
+        max_delay: Optional[float],
+        jitter: bool,
+        deadline: Optional[float],
+        retry_on: Optional[Callable[[BaseException], bool]],
+        statuses: Collection[int],
+        budget: RetryBudget,
+    ):
+        self.retries = retries
+        self.delay = delay
+        self.step = step
+        self.factor = factor
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.deadline = deadline
+        self.retry_on = retry_on
+        self.statuses = statuses
+        self.budget = budget
+
+    def start(self) -> Tuple[Backoff, Optional[float]]:
+        self.budget.deposit()
+        expire_at = None if self.deadline is None else monotonic() + self.deadline
+        return Backoff(self.delay, self.step, self.factor, self.max_delay, self.jitter), expire_at
+
+    def wait(self, name: str, backoff: Backoff, err: Exception) -> Optional[float]:
+        """下一次重试前的延迟，异常带有上游要求的 retry_after 时至少等待该时间，超过 max_delay 时返回 None 不再重试"""
+        wait = backoff.next()
+        hint = getattr(err, "retry_after", None)
+        if hint is None:
+            return wait
+        if self.max_delay is not None and hint > self.max_delay:
+            logger.warning("{} upstream asks to retry after {:.0f}s, exceeds max delay {}s", name, hint, self.max_delay)
+            return None
+        return max(wait, hint)
+
+    def should_retry(self, name: str, err: Exception, times: int, wait: float, expire_at: Optional[float]) -> bool:
+        if times >= self.retries:
+            return False
+        if not retryable(err, self.retry_on, self.statuses):
+            logger.warning("{} err is not retryable: {!r}", name, err)
+            return False
+        if expire_at is not None and monotonic() + wait > expire_at:
+            logger.warning("{} retry deadline {}s exceeded", name, self.deadline)
+            return False
+        if not self.budget.withdraw():
+            logger.warning("{} retry budget exhausted", name)
+            return False
+        return True
+
+
+def retry(
+    retries: int = 5,
+    delay: Union[int, float] = 0,
+    step: Union[int, float] = 0,
+    *,
+    factor: float = 1,
+    max_delay: Optional[float] = None,
+    jitter: bool = False,
+    deadline: Optional[float] = None,
+    retry_on: Optional[Callable[[BaseException], bool]] = None,
+    statuses: Collection[int] = RETRYABLE_STATUS,
+    budget: Optional[RetryBudget] = None,
+):
+    """函数执行出现异常时自动重试的装饰器，每次调用的延迟互不影响
 
     >>> @retry(retries=2, delay=60, step=60)
     >>> def func():
     >>>     ...
 
-    :param retries: 最多重试次数
-    :param delay: 每次重试的延迟，单位秒
-    :param step: 每次重试后延迟递增，单位秒
+    >>> @retry(retries=5, delay=1, factor=2, max_delay=30, jitter=True, deadline=120)
+    >>> def func():
+    >>>     ...
+
+    :param retries: 最多执行次数
+    :param delay: 第一次重试的延迟，单位秒
+    :param step: 每次重试后延迟线性递增，单位秒
+    :param factor: 每次重试后延迟按倍数递增
+    :param max_delay: 单次延迟的上限，上游通过 Retry-After 要求更久时不再重试，单位秒
+    :param jitter: 在 [0, 延迟] 内随机取延迟（full jitter），避免多个调用方同时重试
+    :param deadline: 从第一次调用开始计算的总时限，下一次重试会超过时限时不再重试，单位秒
+    :param retry_on: 额外的重试条件，返回 False 时不再重试
+    :param statuses: 带 status_code 的异常只在这些状态码时重试
+    :param budget: 重试预算，为 None 时每个被装饰的函数使用独立的预算，某个上游故障不会耗尽其他函数的重试，
+                   访问同一上游的多个函数可以传入同一个 RetryBudget 共享
     """
 
+    budget = RetryBudget() if budget is None else budget
+    policy = RetryPolicy(retries, delay, step, factor, max_delay, jitter, deadline, retry_on, statuses, budget)
+
     def retry_decorator(func: Callable):
         @wraps(func)
         async def do_func_and_retries(*args, **kwargs):
-            times = 1
-            errors = []
-            nonlocal delay, step, retries
-
-            while times <= retries:
+            errors: List[Exception] = []
+            backoff, expire_at = policy.start()
+            for times in range(1, retries + 1):
                 try:
                     logger.info("call the {} {} times", func.__name__, times)
                     return await func(*args, **kwargs)
-                except BaseException as err:  # noqa: PIE786
-                    logger.warning(
-                        "call the {} {} times err: {}, traceback: {}", func.__name__, times, err, format_exc()
-                    )
+                except Exception as err:
+                    logger.warning("call the {} {} times err: {!r}", func.__name__, times, err)
                     errors.append(err)
-                    times += 1
-                    if (delay > 0 or step > 0) and times < retries:
-                        await sleep(delay)
-                        delay += step
-            else:
-                err = MaxRetriesException(func, retries, errors)
-                raise err
+                    wait = policy.wait(func.__name__, backoff, err)
+                    if wait is None or not policy.should_retry(func.__name__, err, times, wait, expire_at):
+                        break
+                    if wait > 0:
+                        await sleep(wait)
+
+            if errors:
+                logger.opt(exception=errors[-1]).warning("{} failed after {} times", func.__name__, len(errors))
+            raise MaxRetriesException(func, len(errors), errors)
 
         return do_func_and_retries
 
@@ -0,0 +1,167 @@
+from ipaddress import collapse_addresses, ip_network
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+DOMAIN = "DOMAIN"
+DOMAIN_SUFFIX = "DOMAIN-SUFFIX"
+IP_CIDR = "IP-CIDR"
+IP_CIDR6 = "IP-CIDR6"
+
+
+class RuleStats(NamedTuple):
+    before: int
+    duplicates: int
+    shadowed: int
+    collapsed: int
+    after: int
+
+
+class SuffixTrie:
+    """按反转的域名标签组织的前缀树，用于判断域名是否被更早的 DOMAIN-SUFFIX 覆盖"""
+
+    __slots__ = ("__root",)
+
+    # 终止标记，域名标签不会为空字符串
+    END = ""
+
+    def __init__(self):
+        self.__root: Dict[str, dict] = {}
+
+    def insert(self, domain: str):
+        node = self.__root
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        node[self.END] = {}
+
+    def covers(self, domain: str) -> bool:
+        node = self.__root
+        for label in reversed(domain.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if self.END in node:
+                return True
+        return False
+
+
+def parse_cidr_rule(rule: str) -> Optional[Tuple[Tuple[str, str, Tuple[str, ...]], str]]:
+    """IP-CIDR / IP-CIDR6 规则拆成 ((类型, 策略组, 附加参数), 网段)，其他规则返回 None"""
+    parts = rule.split(",")
+    if len(parts) < 3 or parts[0] not in (IP_CIDR, IP_CIDR6):
+        return None
+    return (parts[0], parts[2], tuple(parts[3:])), parts[1]
+
+
+def collapse_cidr_rules(rules: List[str]) -> List[str]:
+    """合并相邻且类型、策略组、附加参数都相同的 IP-CIDR 规则，不跨越其他规则，因此不改变匹配顺序"""
+    result: List[str] = []
+    run_key, run_networks, run_rules = None, [], []
+
+    def flush():
+        if len(run_rules) < 2:
+            result.extend(run_rules)
+            return
+        try:
+            networks = list(collapse_addresses(ip_network(network, strict=False) for network in run_networks))
+        except (TypeError, ValueError):
+            result.extend(run_rules)
+            return
+        kind, target, options = run_key
+        result.extend(",".join((kind, str(network), target, *options)) for network in networks)
+
+    for rule in rules:
+        parsed = parse_cidr_rule(rule)
+        key = parsed[0] if parsed else None
+        if key is None or key != run_key:
+            flush()
+            run_key, run_networks, run_rules = key, [], []
+        if key is None:
+            result.append(rule)
+        else:
+            run_networks.append(parsed[1])
+            run_rules.append(rule)
+    flush()
+
+    return result
+
+
+def optimize_rules(rules: List[str]) -> Tuple[List[str], RuleStats]:
+    """在不改变匹配结果的前提下精简规则
+
+    Clash 按顺序逐条匹配，命中第一条即停止，因此：
+    - 完全重复的规则只保留第一条
+    - 被更早的 DOMAIN-SUFFIX 覆盖的 DOMAIN / DOMAIN-SUFFIX，以及重复的 DOMAIN 永远不会被命中
+    - 相邻且指向同一策略组的 IP-CIDR 可以合并为更少的网段
+    """
+    seen = set()
+    domains = set()
+    suffixes = SuffixTrie()
+    duplicates = shadowed = 0
+
+    deduped: List[str] = []
+    for rule in rules:
+        if rule in seen:
+            duplicates += 1
+            continue
+        seen.add(rule)
+
+        parts = rule.split(",")
+        if len(parts) >= 3 and parts[0] in (DOMAIN, DOMAIN_SUFFIX):
+            domain = parts[1].lower()
+            if suffixes.covers(domain) or (parts[0] == DOMAIN and domain in domains):
+                shadowed += 1
+                continue
+            if parts[0] == DOMAIN_SUFFIX:
+                suffixes.insert(domain)
+            else:
+                domains.add(domain)
+        deduped.append(rule)
+
+    optimized = collapse_cidr_rules(deduped)
+    return optimized, RuleStats(
+        before=len(rules),
+        duplicates=duplicates,
+        shadowed=shadowed,
+        collapsed=len(deduped) - len(optimized),
+        after=len(optimized),
+    )
+
+
+class RuleSet(NamedTuple):
+    target: str
+    payload: List[str]
+
+
+def rule_target(rule: str) -> Optional[str]:
+    parts = rule.split(",")
+    return parts[2] if len(parts) >= 3 else None
+
+
+def split_rule_sets(rules: List[str], min_rules: int) -> List[Union[str, RuleSet]]:
+    """把连续指向同一策略组且不少于 min_rules 条的规则拆成 RuleSet
+
+    只拆连续的规则，RULE-SET 放在原来的位置上，不改变匹配顺序。RuleSet.payload 中的规则去掉了策略组，
+    即 Clash rule-provider 的 classical 格式。
+    """
+    result: List[Union[str, RuleSet]] = []
+    run_target, run_rules = None, []
+
+    def flush():
+        if run_target is not None and len(run_rules) >= min_rules:
+            payload = []
+            for rule in run_rules:
+                parts = rule.split(",")
+                del parts[2]
+                payload.append(",".join(parts))
+            result.append(RuleSet(target=run_target, payload=payload))
+        else:
+            result.extend(run_rules)
+
+    for rule in rules:
+        target = rule_target(rule)
+        if target is None or target != run_target:
+            flush()
+            run_target, run_rules = target, []
+        run_rules.append(rule)
+    flush()
+
+    return result
@@ -0,0 +1,178 @@
+from datetime import datetime, timedelta
+from functools import wraps
+from typing import Callable, Optional
+
+from apscheduler.job import Job
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.jobstores.redis import RedisJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.base import BaseTrigger
+from loguru import logger
+
+from components.getsetter import GetSetTer
+from setting import JobStore, setting
+
+scheduler = GetSetTer()
+
+
+def job_defaults() -> dict:
+    cfg = setting.scheduler
+    return {"misfire_grace_time": cfg.misfire_grace_time, "coalesce": cfg.coalesce, "max_instances": cfg.max_instances}
+
+
+async def register_scheduler() -> AsyncIOScheduler:
+    """创建并以暂停状态启动调度器，任务注册完成后再由调用方 resume
+
+    RedisJobStore 使用同步的 redis-py 客户端，调度、get_job 与 modify_job 都会在事件循环中阻塞地访问 Redis，
+    必须设置 socket 超时，否则一个卡住的连接会让事件循环（包括租约续期与订阅服务）无限期停顿
+    """
+    cfg = setting.scheduler
+    if cfg.jobstore == JobStore.redis:
+        jobstore = RedisJobStore(
+            jobs_key=cfg.jobs_key,
+            run_times_key=cfg.run_times_key,
+            host=setting.redis.host,
+            port=setting.redis.port,
+            password=setting.redis.password,
+            socket_timeout=cfg.socket_timeout,
+            socket_connect_timeout=cfg.socket_timeout,
+            retry_on_timeout=True,
+        )
+    else:
+        jobstore = MemoryJobStore()
+
+    scheduler.val = AsyncIOScheduler(jobstores={"default": jobstore}, job_defaults=job_defaults())
+    scheduler.val.start(paused=True)
+    return scheduler.val
+
+
+async def close_scheduler():
+    sched: AsyncIOScheduler = scheduler.val
+    sched.shutdown(wait=False)
+
+
+def ensure_job(func: Callable, trigger: BaseTrigger) -> Job:
+    """以函数名作为任务 id 注册任务
+
+    job store 中已有同一任务时保留其下次运行时间，只在触发规则变化时才重新计算，
+    重启不会重置 15 天的间隔，也不会错过重启期间应该执行的任务
+    """
+    sched: AsyncIOScheduler = scheduler.val
+    job_id = func.__name__
+    job = sched.get_job(job_id)
+    if job is None:
+        logger.info("add job {}, trigger: {}", job_id, trigger)
+        return sched.add_job(func, trigger, id=job_id, name=job_id)
+
+    defaults = job_defaults()
+    if any(getattr(job, key) != value for key, value in defaults.items()):
+        job = sched.modify_job(job_id, **defaults)
+
+    if str(job.trigger) != str(trigger):
+        logger.info("reschedule job {}, trigger: {} -> {}", job_id, job.trigger, trigger)
+        return sched.reschedule_job(job_id, trigger=trigger)
+
+    logger.info("restore job {}, next run time: {}", job_id, job.next_run_time)
+    return job
+
+
+def trigger_job(job_id: str, delay: Optional[float] = None):
+    """让任务在 delay 秒后提前运行一次，之后仍按原来的触发规则运行
+
+    任务已经会在 delay 秒内运行时不做修改，短时间内的多次触发只会运行一次
+    """
+    sched: Optional[AsyncIOScheduler] = scheduler.val
+    if sched is None:
+        return
+
+    job = sched.get_job(job_id)
+    if job is None:
+        logger.warning("trigger job {} failed, job not found", job_id)
+        return
+
+    delay = setting.scheduler.chain_delay if delay is None else delay
+    run_time = datetime.now(sched.timezone) + timedelta(seconds=delay)
+    if job.next_run_time is not None and job.next_run_time <= run_time:
+        logger.info("job {} will run at {}, skip triggering", job_id, job.next_run_time)
+        return
+
+    logger.info("trigger job {}, run at {}", job_id, run_time)
+    sched.modify_job(job_id, next_run_time=run_time)
+
+
+def on_success(*job_ids: str):
+    """任务成功完成后触发下游任务，需要放在 @monitor 之内，任务抛出异常时不会触发
+
+    >>> @monitor
+    ... @on_success("refresh_clash_subscription")
+    ... async def refresh_clash_config():
+    ...     ...
+    """
+
+    def decorator(func):
+        @wraps(func)
+        async def do_func_and_trigger(*args, **kwargs):
+            result = await func(*args, **kwargs)
+            for job_id in job_ids:
+                trigger_job(job_id)
+            return result
+
+        return do_func_and_trigger
+
+    return decorator
+
+
+class AdaptiveInterval:
+    """根据内容是否变化调整任务的下次运行时间
+
+    内容变化后缩短到 min_interval，未变化时按 factor 指数退避直到 max_interval，
+    上游要求的间隔（Retry-After / Cache-Control）更长时以上游为准，但不超过 max_hint，
+    任务异常退出没有调用 reschedule 时按原来的触发规则运行
+    """
+
+    __slots__ = ("__job_id", "__interval", "__deferred")
+
+    def __init__(self, job_id: str):
+        self.__job_id = job_id
+        self.__interval: Optional[float] = None
+        self.__deferred: Optional[float] = None
+
+    @property
+    def deferred(self) -> Optional[float]:
+        return self.__deferred
+
+    def defer(self, hint: Optional[float]):
+        """记录上游在错误响应（429 / 503）中要求的等待时间，在下一次 reschedule 时生效"""
+        if hint is not None:
+            self.__deferred = max(hint, self.__deferred or 0)
+
+    def reschedule(self, changed: Optional[bool], hint: Optional[float] = None):
+        """changed 为 None 表示无法判断内容是否变化（如上次的指纹已过期），保持当前间隔"""
+        cfg = setting.polling
+        sched: Optional[AsyncIOScheduler] = scheduler.val
+        if not cfg.enable or sched is None:
+            return
+
+        job = sched.get_job(self.__job_id)
+        if job is None:
+            return
+
+        trigger_interval = getattr(job.trigger, "interval", None)
+        base = self.__interval or (trigger_interval.total_seconds() if trigger_interval else cfg.min_interval)
+        if changed:
+            interval = cfg.min_interval
+        elif changed is None:
+            interval = min(base, cfg.max_interval)
+        else:
+            interval = min(base * cfg.factor, cfg.max_interval)
+        self.__interval = interval
+
+        hint = max((value for value in (hint, self.__deferred) if value is not None), default=None)
+        self.__deferred = None
+        if hint is not None and hint > interval:
+            logger.info("job {} upstream asks to wait {:.0f}s, capped at {:.0f}s", self.__job_id, hint, cfg.max_hint)
+            interval = max(interval, min(hint, cfg.max_hint))
+
+        run_time = datetime.now(sched.timezone) + timedelta(seconds=interval)
+        logger.info("job {} changed: {}, next run in {:.0f}s at {}", self.__job_id, changed, interval, run_time)
+        sched.modify_job(self.__job_id, next_run_time=run_time)
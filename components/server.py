@@ -0,0 +1,184 @@
+import asyncio
+from hmac import compare_digest
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+from loguru import logger
+
+from components import redis
+from components.artifacts import (
+    ARTIFACT_CURRENT_KEY,
+    ARTIFACT_KEY,
+    ARTIFACT_NAMES,
+    ARTIFACT_USER_INFO,
+    SUBSCRIPTION_CHANNEL,
+    Artifact,
+)
+from components.getsetter import GetSetTer
+from setting import setting
+
+runner = GetSetTer()
+reloader = GetSetTer()
+
+
+class SubscriptionStore:
+    """内存中的最新订阅，只在 Redis 中的 current 版本变化时才重新加载订阅内容，流量信息每次都重新读取"""
+
+    __slots__ = ("version", "artifacts", "user_info")
+
+    def __init__(self):
+        self.version: Optional[str] = None
+        self.artifacts: Dict[str, Artifact] = {}
+        self.user_info: Optional[str] = None
+
+    async def reload(self):
+        rdb = redis.client()
+        current = await rdb.get(ARTIFACT_CURRENT_KEY)
+        if current is None:
+            return
+
+        version = current.decode()
+        user_info_key = ARTIFACT_KEY.format(version, ARTIFACT_USER_INFO)
+        if version == self.version:
+            user_info = await rdb.get(user_info_key)
+            self.user_info = user_info.decode() if user_info is not None else None
+            return
+
+        # 版本号对应的订阅内容发布后不再改变，流量信息在订阅未变化时由 extend_subscription 原地更新，
+        # 所以版本未变化时仍要重新读取流量信息，流量信息只用于展示，与订阅内容不需要严格匹配
+        async with rdb.pipeline(transaction=False) as pipe:
+            for name in ARTIFACT_NAMES:
+                pipe.hgetall(ARTIFACT_KEY.format(version, name))
+            *mappings, user_info = await pipe.get(user_info_key).execute()
+
+        artifacts = {name: Artifact.loads(name, mapping) for name, mapping in zip(ARTIFACT_NAMES, mappings) if mapping}
+        if len(artifacts) != len(ARTIFACT_NAMES):
+            logger.warning("subscription artifacts of version {} are incomplete, skip reloading", version)
+            return
+
+        self.version, self.artifacts = version, artifacts
+        self.user_info = user_info.decode() if user_info is not None else None
+        logger.info("subscription server reloaded, version: {}", self.version)
+
+
+store = SubscriptionStore()
+
+
+def accept_encodings(header: str) -> List[str]:
+    """解析 Accept-Encoding，按 q 值从高到低返回可接受的编码，忽略 q=0"""
+    encodings: List[Tuple[float, str]] = []
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                continue
+        if coding and quality > 0:
+            encodings.append((quality, coding.strip().lower()))
+    return [coding for _, coding in sorted(encodings, key=lambda x: -x[0])]
+
+
+def negotiate(artifact: Artifact, header: str) -> Tuple[Optional[str], bytes]:
+    for coding in accept_encodings(header):
+        if coding == "br" and artifact.br is not None:
+            return "br", artifact.br
+        if coding in ("gzip", "*"):
+            return "gzip", artifact.gzip
+        if coding == "identity":
+            break
+    return None, artifact.body
+
+
+def representation_etag(etag: str, encoding: Optional[str]) -> str:
+    """同一内容的不同编码是不同的表示，强 ETag 需要区分开"""
+    return etag if encoding is None else f'{etag[:-1]}-{encoding}"'
+
+
+def not_modified(etag: str, header: str) -> bool:
+    """If-None-Match 中任一 ETag 与内容相同即视为未修改，不区分编码"""
+    base = etag[1:-1]
+    for tag in header.split(","):
+        tag = tag.strip().removeprefix("W/").strip('"')
+        if tag == "*" or tag == base or tag.rsplit("-", 1)[0] == base:
+            return True
+    return False
+
+
+async def serve_subscription(request: web.Request) -> web.StreamResponse:
+    token = setting.server.token
+    if token is not None and not compare_digest(request.query.get("token", ""), token):
+        raise web.HTTPForbidden()
+
+    artifact = store.artifacts.get(request.match_info.get("name", "clash"))
+    if artifact is None:
+        raise web.HTTPNotFound()
+
+    encoding, body = negotiate(artifact, request.headers.get("Accept-Encoding", ""))
+    headers = {
+        "ETag": representation_etag(artifact.etag, encoding),
+        "Vary": "Accept-Encoding",
+        "Cache-Control": "no-cache",
+    }
+    if store.user_info is not None:
+        headers["subscription-userinfo"] = store.user_info
+
+    if not_modified(artifact.etag, request.headers.get("If-None-Match", "")):
+        return web.Response(status=304, headers=headers)
+
+    headers["Content-Type"] = artifact.content_type
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return web.Response(body=body, headers=headers)
+
+
+async def reload_forever():
+    """收到发布通知时立即重新加载，未收到通知时每隔 reload_interval 秒检查一次
+
+    启动时 Redis 不可用也不会退出，订阅频道与加载失败时按指数退避重试，退避上限为 reload_interval
+    """
+    interval = setting.server.reload_interval
+    pubsub = redis.client().pubsub()
+    delay = 1.0
+    try:
+        while True:
+            try:
+                if not pubsub.subscribed:
+                    await pubsub.subscribe(SUBSCRIPTION_CHANNEL)
+                await store.reload()
+                await pubsub.get_message(ignore_subscribe_messages=True, timeout=interval)
+                delay = 1.0
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("subscription server reload failed, retry in {:.0f}s: {}", delay, e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, interval)
+    finally:
+        await pubsub.close()
+
+
+async def register_server():
+    cfg = setting.server
+    if not cfg.enable:
+        return
+
+    app = web.Application()
+    app.router.add_get("/subscription", serve_subscription)
+    app.router.add_get("/subscription/{name}", serve_subscription)
+
+    runner.val = web.AppRunner(app, access_log=None)
+    await runner.val.setup()
+    await web.TCPSite(runner.val, cfg.host, cfg.port).start()
+    reloader.val = asyncio.create_task(reload_forever())
+    logger.info("subscription server listening on {}:{}", cfg.host, cfg.port)
+
+
+async def close_server():
+    if runner.val is None:
+        return
+
+    reloader.val.cancel()
+    await runner.val.cleanup()
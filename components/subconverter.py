@@ -0,0 +1,193 @@
+from asyncio import gather
+from hashlib import sha1
+from os import makedirs, path
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+from aiofile import async_open
+from loguru import logger
+
+from components.codec import dump_json, load_json, load_yaml
+from components.config import get_real_path
+from components.executor import run
+from components.requests import get
+from components.retry import retry
+from setting import setting
+
+# 按 subconverter 的配置文件（ini）在本地生成 clash 的 rules，省去远程 subconverter 的一次往返
+RULESET_KEYS = ("ruleset", "surge_ruleset")
+INLINE_PREFIX = "[]"
+# subconverter 识别的规则列表类型，surge、quanx 与不带前缀的来源都是每行一条的 classical 规则，
+# clash 的三种类型是 payload: 列表，domain 与 ipcidr 需要展开成 DOMAIN-SUFFIX、DOMAIN、IP-CIDR 规则
+CLASSICAL = "classical"
+CLASH_CLASSIC = "clash-classic"
+CLASH_DOMAIN = "clash-domain"
+CLASH_IPCIDR = "clash-ipcidr"
+SOURCE_TYPES = (CLASH_CLASSIC, CLASH_DOMAIN, CLASH_IPCIDR, "surge", "quanx")
+PAYLOAD_PREFIX = "payload:"
+# clash 支持的规则类型，其余类型（如 USER-AGENT、URL-REGEX）subconverter 会丢弃
+CLASH_RULE_TYPES = {
+    "DOMAIN",
+    "DOMAIN-SUFFIX",
+    "DOMAIN-KEYWORD",
+    "IP-CIDR",
+    "IP-CIDR6",
+    "SRC-IP-CIDR",
+    "GEOIP",
+    "DST-PORT",
+    "SRC-PORT",
+    "PROCESS-NAME",
+    "MATCH",
+}
+
+
+def parse_rulesets(ini: str, base_url: str) -> List[Tuple[str, str, str]]:
+    """解析 ini 中的 ruleset=策略组,[类型:]来源[,刷新间隔]，返回 (策略组, 类型, 来源)，来源为 URL 或 []内联规则"""
+    rulesets = []
+    for line in ini.splitlines():
+        key, _, value = line.strip().partition("=")
+        if key.strip() not in RULESET_KEYS or not value:
+            continue
+
+        group, _, source = value.partition(",")
+        kind = CLASSICAL
+        if not source.startswith(INLINE_PREFIX):
+            head, _, tail = source.rpartition(",")
+            if head and tail.isdigit():
+                source = head
+            prefix, _, rest = source.partition(":")
+            if prefix in SOURCE_TYPES:
+                kind = prefix if prefix.startswith("clash-") else CLASSICAL
+                source = rest
+            source = urljoin(base_url, source)
+        rulesets.append((group.strip(), kind, source.strip()))
+    return rulesets
+
+
+def convert_rule(line: str, group: str) -> Optional[str]:
+    """把规则列表中的一行转成 clash 规则，注释、空行与 clash 不支持的类型返回 None"""
+    line = line.strip()
+    if not line or line.startswith(("#", ";", "//")):
+        return None
+
+    parts = [part.strip() for part in line.split(",")]
+    if parts[0] == "FINAL":
+        parts[0] = "MATCH"
+    if parts[0] not in CLASH_RULE_TYPES:
+        return None
+    if parts[0] == "MATCH":
+        return f"MATCH,{group}"
+    if len(parts) < 2:
+        return None
+    return ",".join([parts[0], parts[1], group, *parts[2:]])
+
+
+def expand_payload(item: str, kind: str) -> str:
+    """把 clash 规则集 payload 中的一项展开成 classical 规则，domain 中的 +. 与 . 开头的项匹配所有子域名"""
+    item = item.strip().strip("'\"")
+    if kind == CLASH_DOMAIN:
+        if item.startswith(("+.", ".")):
+            return f"DOMAIN-SUFFIX,{item.lstrip('+.')}"
+        return f"DOMAIN,{item}"
+    if kind == CLASH_IPCIDR:
+        return f"{'IP-CIDR6' if ':' in item else 'IP-CIDR'},{item}"
+    return item
+
+
+def source_lines(body: bytes, kind: str) -> List[str]:
+    """把规则来源转成 classical 规则行，不带前缀的来源内容为 payload: 列表时同样按 clash-classic 处理"""
+    text = body.decode("utf-8")
+    if kind == CLASSICAL and not text.lstrip().startswith(PAYLOAD_PREFIX):
+        return text.splitlines()
+
+    payload = (load_yaml(text) or {}).get("payload") or []
+    kind = CLASH_CLASSIC if kind == CLASSICAL else kind
+    return [expand_payload(str(item), kind) for item in payload]
+
+
+def build_rules(rulesets: List[Tuple[str, str, str]], bodies: Dict[str, bytes]) -> List[str]:
+    """按 parse_rulesets 的结果与各来源的内容生成 clash 规则
+
+    某个来源没有转换出任何规则时多半是格式不支持，抛出 ValueError 由调用方回退到远程 subconverter
+    """
+    rules: List[str] = []
+    for group, kind, source in rulesets:
+        if source.startswith(INLINE_PREFIX):
+            rule = convert_rule(source[len(INLINE_PREFIX) :], group)
+            rules.extend([rule] if rule is not None else [])
+            continue
+
+        lines = source_lines(bodies[source], kind)
+        converted = [rule for rule in (convert_rule(line, group) for line in lines) if rule is not None]
+        if not converted:
+            raise ValueError(f"规则来源没有转换出任何规则 {source}")
+        rules.extend(converted)
+    return rules
+
+
+class DiskCache:
+    """规则来源的磁盘缓存，保存 body 与校验器，用于条件请求"""
+
+    def __init__(self, directory: str):
+        self.__directory = directory
+
+    def __paths(self, url: str) -> Tuple[str, str]:
+        name = sha1(url.encode()).hexdigest()
+        return path.join(self.__directory, f"{name}.body"), path.join(self.__directory, f"{name}.json")
+
+    async def load(self, url: str) -> Tuple[Optional[bytes], dict]:
+        body_path, meta_path = self.__paths(url)
+        if not path.exists(body_path) or not path.exists(meta_path):
+            return None, {}
+        async with async_open(body_path, "rb") as file:
+            body = await file.read()
+        async with async_open(meta_path, "rb") as file:
+            meta = load_json(await file.read())
+        return body, meta
+
+    async def save(self, url: str, body: bytes, meta: dict):
+        makedirs(self.__directory, exist_ok=True)
+        body_path, meta_path = self.__paths(url)
+        async with async_open(body_path, "wb") as file:
+            await file.write(body)
+        async with async_open(meta_path, "wb") as file:
+            await file.write(dump_json(meta))
+
+
+def cache() -> DiskCache:
+    return DiskCache(path.join(get_real_path("..", __file__), setting.subconverter.cache_dir))
+
+
+@retry(retries=3)
+async def fetch_source(url: str) -> bytes:
+    """获取规则来源，已缓存时带上 If-None-Match / If-Modified-Since 重新校验"""
+    disk = cache()
+    body, meta = await disk.load(url)
+    headers = {}
+    if body is not None:
+        if meta.get("etag"):
+            headers["If-None-Match"] = meta["etag"]
+        if meta.get("last_modified"):
+            headers["If-Modified-Since"] = meta["last_modified"]
+
+    rsp = await get(url, headers=headers)
+    if rsp.status_code == 304 and body is not None:
+        return body
+    rsp.raise_for_status(f"规则来源获取失败 {url}")
+
+    await disk.save(
+        url, rsp.content, {"etag": rsp.headers.get("ETag"), "last_modified": rsp.headers.get("Last-Modified")}
+    )
+    return rsp.content
+
+
+async def convert_rules(config_url: str) -> List[str]:
+    """按 subconverter 配置文件在本地生成 clash 规则，结果与远程 subconverter 的 rules 一致"""
+    ini = (await fetch_source(config_url)).decode("utf-8")
+    rulesets = parse_rulesets(ini, config_url)
+    urls = list(dict.fromkeys(source for _, _, source in rulesets if not source.startswith(INLINE_PREFIX)))
+    bodies = dict(zip(urls, await gather(*(fetch_source(url) for url in urls))))
+    # 规则列表可能有数万行，解析 payload 与转换都放到 codec 执行器中，避免阻塞事件循环
+    rules = await run(build_rules, rulesets, bodies)
+    logger.info("convert {} rulesets into {} clash rules locally", len(rulesets), len(rules))
+    return rules
@@ -0,0 +1,68 @@
+from hashlib import blake2b
+from os import stat
+from typing import Any, Optional
+
+from aiofile import async_open
+from loguru import logger
+
+from components.codec import load_yaml
+from components.config import get_real_path
+from components.executor import run
+
+
+def digest(content: bytes) -> str:
+    return blake2b(content, digest_size=16).hexdigest()
+
+
+def structural_copy(data: Any) -> Any:
+    """只复制 dict 与 list，标量直接共享，比 deepcopy 省去 memo 与类型分派的开销"""
+    if isinstance(data, dict):
+        return {key: structural_copy(value) for key, value in data.items()}
+    if isinstance(data, list):
+        return [structural_copy(value) for value in data]
+    return data
+
+
+class YamlTemplate:
+    """常驻内存的 YAML 模板，仅在文件 mtime 与内容都变化或被显式失效时才重新解析"""
+
+    def __init__(self, cfg_file: str, base_file: str):
+        self.__path = get_real_path(cfg_file, base_file)
+        self.__mtime_ns: Optional[int] = None
+        self.__digest: Optional[str] = None
+        self.__data: Optional[dict] = None
+
+    @property
+    def path(self) -> str:
+        return self.__path
+
+    @property
+    def digest(self) -> Optional[str]:
+        """最近一次加载的模板内容摘要"""
+        return self.__digest
+
+    def invalidate(self):
+        """模板文件被改写后调用，下次 load 时重新检查文件内容"""
+        self.__mtime_ns = None
+
+    async def refresh(self):
+        """按需重新加载模板，文件 mtime 未变化时只需一次 stat"""
+        mtime_ns = stat(self.__path).st_mtime_ns
+        if self.__data is None or mtime_ns != self.__mtime_ns:
+            async with async_open(self.__path, "rb") as file:
+                content = await file.read()
+
+            content_digest = digest(content)
+            if self.__data is None or content_digest != self.__digest:
+                logger.info("load yaml template {}, digest: {}", self.__path, content_digest)
+                self.__data = await run(load_yaml, content)
+                self.__digest = content_digest
+            self.__mtime_ns = mtime_ns
+
+    async def load(self) -> dict:
+        """返回模板的结构化副本，调用方可以随意修改"""
+        await self.refresh()
+        return structural_copy(self.__data)
+
+
+clash_template = YamlTemplate("../config/clash.yaml", __file__)
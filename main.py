@@ -1,14 +1,20 @@
 import asyncio
 import logging
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from loguru import logger
 
+from components.executor import close_executor, register_executor
+from components.leader import close_leader, register_leader
 from components.redis import register_redis
 from components.requests import close_requests, register_requests
+from components.scheduler import close_scheduler, ensure_job, register_scheduler
+from components.server import close_server, register_server
 from script.checkin_daily import checkin_daily
 from script.refresh_clash_config import refresh_clash_config
 from script.refresh_clash_subscription import refresh_clash_subscription
+from setting import setting
 
 
 class InterceptHandler(logging.Handler):
@@ -39,14 +45,22 @@ if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     loop.run_until_complete(register_redis())
     loop.run_until_complete(register_requests())
+    loop.run_until_complete(register_executor())
+    loop.run_until_complete(register_server())
 
-    scheduler = AsyncIOScheduler()
-    scheduler.add_job(checkin_daily, "cron", hour=0, minute=10)
-    scheduler.add_job(refresh_clash_config, "interval", days=15)
-    scheduler.add_job(refresh_clash_subscription, "interval", minutes=10)
-    scheduler.start()
+    scheduler = loop.run_until_complete(register_scheduler())
+    ensure_job(checkin_daily, CronTrigger(hour=0, minute=10))
+    ensure_job(refresh_clash_config, IntervalTrigger(days=15))
+    ensure_job(refresh_clash_subscription, IntervalTrigger(minutes=10))
+    if not setting.leader.enable:
+        scheduler.resume()
+    loop.run_until_complete(register_leader(scheduler))
 
     try:
         loop.run_forever()
     except (KeyboardInterrupt, SystemExit):
+        loop.run_until_complete(close_leader())
+        loop.run_until_complete(close_scheduler())
+        loop.run_until_complete(close_server())
+        loop.run_until_complete(close_executor())
         loop.run_until_complete(close_requests())
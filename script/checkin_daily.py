@@ -3,6 +3,7 @@ import asyncio
 from aiohttp.typedefs import LooseCookies
 from loguru import logger
 
+from components.leader import check_leader
 from components.monitor import monitor
 from components.requests import close_requests, post, register_requests
 from components.retry import retry
@@ -39,6 +40,8 @@ async def checkin(cookies: LooseCookies):
 
 @monitor
 async def checkin_daily():
+    # 签到是外部副作用，无法放进 MULTI/EXEC，执行前确认仍是 leader，避免新旧 leader 重复签到
+    await check_leader()
     cookies = await auth()
     await checkin(cookies)
 
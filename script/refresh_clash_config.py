@@ -1,16 +1,31 @@
 import asyncio
-from typing import List
+import sys
+from asyncio import gather
+from datetime import timedelta
+from difflib import unified_diff
+from os import makedirs, path
+from typing import Dict, List, Optional, Tuple
 
-import yaml
 from aiofile import async_open
 from loguru import logger
 from pydantic import BaseModel, Field
 
+from components import redis
+from components.codec import dump_yaml, load_yaml
 from components.config import get_real_path
+from components.executor import close_executor, register_executor, run
+from components.leader import check_leader, fence
 from components.monitor import monitor
 from components.requests import Response, close_requests, get, register_requests
-from components.retry import retry
-from setting import setting
+from components.retry import MaxRetriesException, retry
+from components.rules import optimize_rules, split_rule_sets
+from components.scheduler import on_success
+from components.subconverter import convert_rules
+from components.template import clash_template, digest
+from setting import ConverterMode, RuleProviderStorage, setting
+
+RULE_PROVIDER_KEY = "subscription:rule-provider:{}"
+RULE_PROVIDER_TTL = timedelta(days=31)
 
 PROXY_GROUP_SET = {
     "🆎 AdBlock",
@@ -341,10 +356,11 @@ class ClashConfig(BaseModel):
     dns: dict = DEFAULT_DNS
     proxies: list = []
     proxy_groups: list = Field(alias="proxy-groups")
+    rule_providers: Optional[Dict[str, dict]] = Field(None, alias="rule-providers")
     rules: List[str]
 
 
-@retry(retries=5)
+@retry(retries=5, delay=1, factor=2, max_delay=30, jitter=True)
 async def get_config() -> Response:
     rsp = await get(
         setting.subconverter.host,
@@ -362,23 +378,96 @@ async def get_config() -> Response:
             "new_name": "true",
         },
         verify_ssl=False,
+        cache=True,
     )
-    assert rsp.ok, f"获取配置失败, {rsp.status_code}"
+    rsp.raise_for_status("获取配置失败")
     return rsp
 
 
 async def save_config(config: ClashConfig):
-    path = get_real_path("../config/clash.yaml")
-    async with async_open(path, "w") as file:
-        await file.write(yaml.safe_dump(config.dict(by_alias=True), allow_unicode=True, width=800, sort_keys=False))
+    # 本地文件无法与租约原子化，写入前确认仍是 leader
+    await check_leader()
+    async with async_open(clash_template.path, "w") as file:
+        await file.write(await run(dump_yaml, config.dict(by_alias=True, exclude_none=True)))
+    clash_template.invalidate()
+
+
+async def save_rule_provider(name: str, content: bytes):
+    cfg = setting.rule_providers
+    if cfg.storage == RuleProviderStorage.disk:
+        directory = path.join(get_real_path("..", __file__), cfg.directory)
+        filename = path.join(directory, f"{name}.yaml")
+        if not path.exists(filename):
+            await check_leader()
+            makedirs(directory, exist_ok=True)
+            async with async_open(filename, "wb") as file:
+                await file.write(content)
+    else:
+        async with redis.client().pipeline(transaction=True) as pipe:
+            await fence(pipe)
+            pipe.set(RULE_PROVIDER_KEY.format(name), redis.encode(content, public=True), ex=RULE_PROVIDER_TTL)
+            await pipe.execute()
+
+
+async def build_rule_providers(rules: List[str]) -> Tuple[List[str], Dict[str, dict]]:
+    """把大的规则族拆成以内容摘要命名的 rule-provider，主配置中只保留 RULE-SET 引用"""
+    cfg = setting.rule_providers
+    base_url = str(cfg.base_url).rstrip("/")
+    inlined: List[str] = []
+    providers: Dict[str, dict] = {}
+
+    for item in split_rule_sets(rules, cfg.min_rules):
+        if isinstance(item, str):
+            inlined.append(item)
+            continue
+
+        content = (await run(dump_yaml, {"payload": item.payload})).encode()
+        name = digest(content)
+        await save_rule_provider(name, content)
+        providers[name] = {
+            "type": "http",
+            "behavior": "classical",
+            "url": f"{base_url}/{name}.yaml",
+            "path": f"./ruleset/{name}.yaml",
+            "interval": cfg.interval,
+        }
+        inlined.append(f"RULE-SET,{name},{item.target}")
+
+    logger.info("split {} rule providers, {} rules left inline", len(providers), len(inlined))
+    return inlined, providers
+
+
+async def get_remote_rules() -> List[str]:
+    result = await get_config()
+    config = await run(load_yaml, result.content)
+    return config["rules"]
+
+
+async def get_rules() -> List[str]:
+    if setting.subconverter.mode == ConverterMode.local:
+        try:
+            return await convert_rules(setting.subconverter.config)
+        except (Exception, MaxRetriesException) as err:
+            logger.exception("convert rules locally failed, fallback to remote subconverter: {}", err)
+    return await get_remote_rules()
+
+
+async def compare_rules():
+    """对比本地转换与远程 subconverter 生成的 rules，用于验证两者一致"""
+    local, remote = await gather(convert_rules(setting.subconverter.config), get_remote_rules())
+    if local == remote:
+        logger.info("local and remote rules are identical, {} rules", len(local))
+        return
+
+    for line in unified_diff(remote, local, "remote", "local", lineterm="", n=1):
+        logger.warning(line)
 
 
 @monitor
+@on_success("refresh_clash_subscription")
 async def refresh_clash_config():
     logger.info("start refreshing the config of clash")
-    result = await get_config()
-    config = yaml.safe_load(result.text)
-    rules: List[str] = config["rules"]
+    rules = await get_rules()
 
     for rule in rules:
         try:
@@ -389,12 +478,29 @@ async def refresh_clash_config():
         else:
             assert proxy_group in PROXY_GROUP_SET, f"clash 配置发现错误: {rule}"
 
-    await save_config(ClashConfig(**{"proxy-groups": PROXY_GROUPS, "rules": rules}))
+    rules, stats = await run(optimize_rules, rules)
+    logger.info(
+        "optimize clash rules {} -> {}, duplicates: {}, shadowed: {}, collapsed: {}",
+        stats.before,
+        stats.after,
+        stats.duplicates,
+        stats.shadowed,
+        stats.collapsed,
+    )
+
+    providers = None
+    if setting.rule_providers.enable:
+        rules, providers = await build_rule_providers(rules)
+
+    await save_config(ClashConfig(**{"proxy-groups": PROXY_GROUPS, "rule-providers": providers, "rules": rules}))
     logger.info("refresh clash config successful")
 
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
+    loop.run_until_complete(redis.register_redis())
     loop.run_until_complete(register_requests())
-    loop.run_until_complete(refresh_clash_config())
+    loop.run_until_complete(register_executor())
+    loop.run_until_complete(compare_rules() if "--compare" in sys.argv else refresh_clash_config())
+    loop.run_until_complete(close_executor())
     loop.run_until_complete(close_requests())
@@ -1,18 +1,53 @@
 import asyncio
+from asyncio import Semaphore, gather
 from datetime import timedelta
-from re import search
-from typing import List, Tuple
+from functools import lru_cache
+from math import inf
+from operator import attrgetter
+from re import Pattern, compile, escape
+from time import time
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
 
-import yaml
+from aiohttp import ClientTimeout
 from loguru import logger
 from pydantic import BaseModel
 
 from components import redis
-from components.config import async_load_yaml_config
-from components.monitor import monitor
-from components.requests import close_requests, get, register_requests
-from components.retry import retry
-from setting import setting
+from components.artifacts import (
+    ARTIFACT_CURRENT_KEY,
+    ARTIFACT_KEY,
+    ARTIFACT_NAMES,
+    ARTIFACT_USER_INFO,
+    SUBSCRIPTION_CHANNEL,
+    SUBSCRIPTION_VERSION_KEY,
+    USER_INFO_KEY,
+    Artifact,
+    render_artifacts,
+)
+from components.codec import load_yaml
+from components.executor import close_executor, register_executor, run
+from components.leader import fence
+from components.monitor import alert, monitor
+from components.probe import probe_proxies
+from components.ranking import load_scores
+from components.requests import Response, close_requests, get, poll_after, register_requests
+from components.retry import MaxRetriesException, retry
+from components.scheduler import AdaptiveInterval
+from components.template import clash_template, digest
+from setting import ProbeAction, Subscription, setting
+
+SUBSCRIPTION_KEY = "subscription:clash"
+SUBSCRIPTION_FINGERPRINT_KEY = "subscription:clash:fingerprint"
+# 订阅 key 过期时间的下限，轮询间隔更长时按 subscription_ttl 延长
+SUBSCRIPTION_TTL = timedelta(hours=1)
+
+polling = AdaptiveInterval("refresh_clash_subscription")
+
+
+def subscription_ttl() -> timedelta:
+    """订阅 key 的过期时间，取最长轮询间隔的两倍，留出获取订阅、重试与重新生成的时间，保证下次刷新前不会过期"""
+    cfg = setting.polling
+    return max(SUBSCRIPTION_TTL, timedelta(seconds=max(cfg.max_interval, cfg.max_hint) * 2))
 
 
 class Proxies(BaseModel):
@@ -26,95 +61,272 @@ class Proxies(BaseModel):
     proxy_names_of_tw_node: List[str]
 
 
-def node_name_matches_country(node_name: str) -> Tuple:  # noqa: C901
-    if search(r"(AR|阿根廷)", node_name):
-        return f"🇦🇷 {node_name}", "AR"
-    if search(r"(AT|奥地利|维也纳)", node_name):
-        return f"🇦🇹 {node_name}", "AT"
-    if search(r"(AU|Australia|Sydney|澳大利亚|悉尼)", node_name):
-        return f"🇦🇺 {node_name}", "AU"
-    if search(r"(BE|比利时)", node_name):
-        return f"🇧🇪 {node_name}", "BE"
-    if search(r"(BR|Brazil|巴西|圣保罗)", node_name):
-        return f"🇧🇷 {node_name}", "BR"
-    if search(r"(CA|Canada|加拿大|蒙特利尔|温哥华|楓葉|枫叶)", node_name):
-        return f"🇨🇦 {node_name}", "CA"
-    if search(r"(CH|瑞士|苏黎世)", node_name):
-        return f"🇨🇭 {node_name}", "CH"
-    if search(r"(DE|Germany|德国|法兰克福|德)", node_name):
-        return f"🇩🇪 {node_name}", "DE"
-    if search(r"(DK|丹麦)", node_name):
-        return f"🇩🇰 {node_name}", "DK"
-    if search(r"(ES|西班牙)", node_name):
-        return f"🇪🇸 {node_name}", "ES"
-    if search(r"EU", node_name):
-        return f"🇪🇺 {node_name}", "EU"
-    if search(r"(FI|Finland|芬兰|赫尔辛基)", node_name):
-        return f"🇫🇮 {node_name}", "FI"
-    if search(r"(FR|France|法国|巴黎)", node_name):
-        return f"🇫🇷 {node_name}", "FR"
-    if search(r"(UK|England|UnitedKingdom|英国|英|伦敦)", node_name):
-        return f"🇬🇧 {node_name}", "UK"
-    if search(r"(HK|HongKong|香港|深港|沪港|呼港|HKT|HKBN|HGC|WTT|CMI|穗港|京港|港)", node_name):
-        return f"🇭🇰 {node_name}", "HK"
-    if search(r"(ID|Indonesia|印尼|印度尼西亚|雅加达)", node_name):
-        return f"🇮🇩 {node_name}", "ID"
-    if search(r"(IE|Ireland|爱尔兰|都柏林)", node_name):
-        return f"🇮🇪 {node_name}", "IE"
-    if search(r"(IN|India|印度|孟买)", node_name):
-        return f"🇮🇳 {node_name}", "IN"
-    if search(r"(IT|Italy|意大利|米兰)", node_name):
-        return f"🇮🇹 {node_name}", "IT"
-    if search(r"(JP|Japan|日本|东京|大阪|埼玉|沪日|穗日|川日|中日|泉日|杭日)", node_name):
-        return f"🇯🇵 {node_name}", "JP"
-    if search(r"(KP|朝鲜)", node_name):
-        return f"🇰🇵 {node_name}", "KP"
-    if search(r"(KR|Korea|KOR|韩国|首尔|韩|韓)", node_name):
-        return f"🇰🇷 {node_name}", "KR"
-    if search(r"(MO|Macao|澳门|CTM)", node_name):
-        return f"🇲🇴 {node_name}", "MO"
-    if search(r"(MY|Malaysia|马来西亚)", node_name):
-        return f"🇲🇾 {node_name}", "MY"
-    if search(r"(NL|Netherlands|荷兰|阿姆斯特丹)", node_name):
-        return f"🇳🇱 {node_name}", "NL"
-    if search(r"(PH|Philippines|菲律宾)", node_name):
-        return f"🇵🇭 {node_name}", "PH"
-    if search(r"(RO|罗马尼亚)", node_name):
-        return f"🇷🇴 {node_name}", "RO"
-    if search(r"(RU|Russia|俄罗斯|伯力|莫斯科|圣彼得堡|西伯利亚|新西伯利亚|京俄|杭俄)", node_name):
-        return f"🇷🇺 {node_name}", "RU"
-    if search(r"(SA|沙特|迪拜)", node_name):
-        return f"🇸🇦 {node_name}", "SA"
-    if search(r"(SE|Sweden)", node_name):
-        return f"🇸🇪 {node_name}", "SE"
-    if search(r"(SG|Singapore|新加坡|狮城|沪新|京新|泉新|穗新|深新|杭新)", node_name):
-        return f"🇸🇬 {node_name}", "SG"
-    if search(r"(TH|Thailand|泰国|曼谷)", node_name):
-        return f"🇹🇭 {node_name}", "TH"
-    if search(r"(TR|Turkey|土耳其|伊斯坦布尔)", node_name):
-        return f"🇹🇷 {node_name}", "TR"
-    if search(r"(PK|Pakistan|巴基斯坦)", node_name):
-        return f"🇵🇰 {node_name}", "PK"
-    if search(
-            r"(US|America|UnitedStates|美国|美|京美|波特兰|达拉斯|俄勒冈|凤凰城|费利蒙|硅谷|拉斯维加斯|洛杉矶|圣何塞|圣克拉拉|西雅图|芝加哥|沪美)",
-            # noqa: E501
-            node_name,
-    ):
-        return f"🇺🇲 {node_name}", "US"
-    if search(r"(VN|越南)", node_name):
-        return f"🇻🇳 {node_name}", "VN"
-    if search(r"(ZA|南非)", node_name):
-        return f"🇿🇦 {node_name}", "ZA"
-    if search(r"(TW|Taiwan|台湾|台北|台中|新北|彰化|CHT|台|HINET)", node_name):
-        return f"🇨🇳 {node_name}", "TW"
-    if search(r"(CN|China|回国|中国|江苏|北京|上海|广州|深圳|杭州|常州|徐州|青岛|宁波|镇江|back)", node_name):
-        return f"🇨🇳 {node_name}", "CN"
-
-    raise ValueError(f"clash 地区匹配失败 -> {node_name}")
-
-
-@retry(retries=5)
-async def get_clash_proxies() -> Proxies:
+class Region(NamedTuple):
+    priority: int
+    flag: str
+    code: str
+    keywords: Tuple[str, ...]
+
+
+# 节点名可能同时命中多个地区的关键字，此时取 priority 最小的地区，例如 "美" 优先于 "台"
+REGIONS: List[Region] = [
+    Region(10, "🇦🇷", "AR", ("AR", "阿根廷")),
+    Region(20, "🇦🇹", "AT", ("AT", "奥地利", "维也纳")),
+    Region(30, "🇦🇺", "AU", ("AU", "Australia", "Sydney", "澳大利亚", "悉尼")),
+    Region(40, "🇧🇪", "BE", ("BE", "比利时")),
+    Region(50, "🇧🇷", "BR", ("BR", "Brazil", "巴西", "圣保罗")),
+    Region(60, "🇨🇦", "CA", ("CA", "Canada", "加拿大", "蒙特利尔", "温哥华", "楓葉", "枫叶")),
+    Region(70, "🇨🇭", "CH", ("CH", "瑞士", "苏黎世")),
+    Region(80, "🇩🇪", "DE", ("DE", "Germany", "德国", "法兰克福", "德")),
+    Region(90, "🇩🇰", "DK", ("DK", "丹麦")),
+    Region(100, "🇪🇸", "ES", ("ES", "西班牙")),
+    Region(110, "🇪🇺", "EU", ("EU",)),
+    Region(120, "🇫🇮", "FI", ("FI", "Finland", "芬兰", "赫尔辛基")),
+    Region(130, "🇫🇷", "FR", ("FR", "France", "法国", "巴黎")),
+    Region(140, "🇬🇧", "UK", ("UK", "England", "UnitedKingdom", "英国", "英", "伦敦")),
+    Region(
+        150,
+        "🇭🇰",
+        "HK",
+        (
+            "HK",
+            "HongKong",
+            "香港",
+            "深港",
+            "沪港",
+            "呼港",
+            "HKT",
+            "HKBN",
+            "HGC",
+            "WTT",
+            "CMI",
+            "穗港",
+            "京港",
+            "港",
+        ),
+    ),
+    Region(160, "🇮🇩", "ID", ("ID", "Indonesia", "印尼", "印度尼西亚", "雅加达")),
+    Region(170, "🇮🇪", "IE", ("IE", "Ireland", "爱尔兰", "都柏林")),
+    Region(180, "🇮🇳", "IN", ("IN", "India", "印度", "孟买")),
+    Region(190, "🇮🇹", "IT", ("IT", "Italy", "意大利", "米兰")),
+    Region(
+        200, "🇯🇵", "JP", ("JP", "Japan", "日本", "东京", "大阪", "埼玉", "沪日", "穗日", "川日", "中日", "泉日", "杭日")
+    ),
+    Region(210, "🇰🇵", "KP", ("KP", "朝鲜")),
+    Region(220, "🇰🇷", "KR", ("KR", "Korea", "KOR", "韩国", "首尔", "韩", "韓")),
+    Region(230, "🇲🇴", "MO", ("MO", "Macao", "澳门", "CTM")),
+    Region(240, "🇲🇾", "MY", ("MY", "Malaysia", "马来西亚")),
+    Region(250, "🇳🇱", "NL", ("NL", "Netherlands", "荷兰", "阿姆斯特丹")),
+    Region(260, "🇵🇭", "PH", ("PH", "Philippines", "菲律宾")),
+    Region(270, "🇷🇴", "RO", ("RO", "罗马尼亚")),
+    Region(
+        280,
+        "🇷🇺",
+        "RU",
+        ("RU", "Russia", "俄罗斯", "伯力", "莫斯科", "圣彼得堡", "西伯利亚", "新西伯利亚", "京俄", "杭俄"),
+    ),
+    Region(290, "🇸🇦", "SA", ("SA", "沙特", "迪拜")),
+    Region(300, "🇸🇪", "SE", ("SE", "Sweden")),
+    Region(310, "🇸🇬", "SG", ("SG", "Singapore", "新加坡", "狮城", "沪新", "京新", "泉新", "穗新", "深新", "杭新")),
+    Region(320, "🇹🇭", "TH", ("TH", "Thailand", "泰国", "曼谷")),
+    Region(330, "🇹🇷", "TR", ("TR", "Turkey", "土耳其", "伊斯坦布尔")),
+    Region(340, "🇵🇰", "PK", ("PK", "Pakistan", "巴基斯坦")),
+    Region(
+        350,
+        "🇺🇲",
+        "US",
+        (
+            "US",
+            "America",
+            "UnitedStates",
+            "美国",
+            "美",
+            "京美",
+            "波特兰",
+            "达拉斯",
+            "俄勒冈",
+            "凤凰城",
+            "费利蒙",
+            "硅谷",
+            "拉斯维加斯",
+            "洛杉矶",
+            "圣何塞",
+            "圣克拉拉",
+            "西雅图",
+            "芝加哥",
+            "沪美",
+        ),
+    ),
+    Region(360, "🇻🇳", "VN", ("VN", "越南")),
+    Region(370, "🇿🇦", "ZA", ("ZA", "南非")),
+    Region(380, "🇨🇳", "TW", ("TW", "Taiwan", "台湾", "台北", "台中", "新北", "彰化", "CHT", "台", "HINET")),
+    Region(
+        390,
+        "🇨🇳",
+        "CN",
+        (
+            "CN",
+            "China",
+            "回国",
+            "中国",
+            "江苏",
+            "北京",
+            "上海",
+            "广州",
+            "深圳",
+            "杭州",
+            "常州",
+            "徐州",
+            "青岛",
+            "宁波",
+            "镇江",
+            "back",
+        ),
+    ),
+]
+
+
+def compile_regions(regions: List[Region]) -> Pattern:
+    """把地区表编译成一个正则
+
+    每个地区是一个命名分组，按 priority 排列在同一个零宽断言中。finditer 会在每个位置各尝试一次，
+    位置上命中的分组即为该位置 priority 最小的地区，再取所有位置中 priority 最小的一个即可，
+    与逐个地区依次 search 的结果一致。
+    """
+    branches = "|".join(
+        f"(?P<{region.code}>{'|'.join(escape(keyword) for keyword in region.keywords)})"
+        for region in sorted(regions, key=attrgetter("priority"))
+    )
+    return compile(f"(?=(?:{branches}))")
+
+
+REGION_PATTERN = compile_regions(REGIONS)
+REGION_BY_CODE: Dict[str, Region] = {region.code: region for region in REGIONS}
+
+
+@lru_cache(maxsize=4096)
+def node_name_matches_country(node_name: str, prefix: str = "") -> Tuple[str, str]:
+    """匹配节点所属地区，返回加上国旗与订阅源前缀的节点名和地区代码，前缀不参与匹配"""
+    region: Optional[Region] = None
+    for match in REGION_PATTERN.finditer(node_name):
+        candidate = REGION_BY_CODE[match.lastgroup]
+        if region is None or candidate.priority < region.priority:
+            region = candidate
+
+    if region is None:
+        raise ValueError(f"clash 地区匹配失败 -> {node_name}")
+    return f"{region.flag} {prefix}{node_name}", region.code
+
+
+@retry(retries=5, delay=1, factor=2, max_delay=30, jitter=True)
+async def get_clash_subscription(source: Subscription) -> Response:
+    kwargs = {} if source.timeout is None else {"timeout": ClientTimeout(total=source.timeout)}
+    rsp = await get(source.url, cache=True, **kwargs)
+    rsp.raise_for_status(f"clash 订阅 {source.name} 获取失败")
+    return rsp
+
+
+async def get_clash_subscriptions() -> List[Tuple[Subscription, Response]]:
+    """并发获取所有订阅源，单个订阅源失败只告警，全部失败时抛出异常"""
+    semaphore = Semaphore(setting.subscription_concurrency)
+
+    async def fetch(source: Subscription) -> Optional[Response]:
+        async with semaphore:
+            try:
+                return await get_clash_subscription(source)
+            except MaxRetriesException as err:
+                logger.error("clash subscription {} failed: {}", source.name, err)
+                await alert(f"clash 订阅 {source.name} 获取失败\n\n{err}")
+                # 429 / 503 的 Retry-After 在重试次数用完后交给轮询间隔，下次刷新不早于上游要求的时间
+                polling.defer(err.retry_after)
+                return None
+
+    responses = await gather(*(fetch(source) for source in setting.subscriptions))
+    subscriptions = [(source, rsp) for source, rsp in zip(setting.subscriptions, responses) if rsp is not None]
+    if not subscriptions and polling.deferred is not None:
+        polling.reschedule(changed=False)
+    assert subscriptions, "clash 订阅全部获取失败"
+    return subscriptions
+
+
+def get_user_info(subscriptions: List[Tuple[Subscription, Response]]) -> Optional[str]:
+    """取第一个带有 subscription-userinfo 的订阅源的流量信息"""
+    for _, rsp in subscriptions:
+        user_info = rsp.headers.get("subscription-userinfo")
+        if user_info is not None:
+            logger.info("subscription user info: {}", user_info)
+            return user_info
+    return None
+
+
+def get_poll_hint(subscriptions: List[Tuple[Subscription, Response]]) -> Optional[float]:
+    """所有订阅源中要求的最长轮询间隔"""
+    hints = [hint for _, rsp in subscriptions if (hint := poll_after(rsp.headers)) is not None]
+    return max(hints) if hints else None
+
+
+def unique_name(node_name: str, names: Set[str]) -> str:
+    name, index = node_name, 2
+    while name in names:
+        name = f"{node_name} {index}"
+        index += 1
+    return name
+
+
+async def merge_nodes(subscriptions: List[Tuple[Subscription, Response]]) -> List[Tuple[dict, str]]:
+    """合并所有订阅源的节点，(type, server, port) 相同的节点只保留 weight 最高的订阅源中的一个"""
+    subscriptions = sorted(subscriptions, key=lambda item: item[0].weight, reverse=True)
+    documents = await gather(*(run(load_yaml, rsp.content) for _, rsp in subscriptions))
+    servers: Set[Tuple] = set()
+    names: Set[str] = set()
+
+    nodes: List[Tuple[dict, str]] = []
+    for (source, _), document in zip(subscriptions, documents):
+        proxies: List[dict] = document.get("proxies", [])
+        for proxy in proxies:
+            if not proxy.get("server") or proxy.get("port") is None:
+                logger.warning("skip proxy {} from {} without server or port", proxy.get("name"), source.name)
+                continue
+
+            server = (proxy.get("type"), proxy.get("server"), proxy.get("port"))
+            if server in servers:
+                logger.info("skip duplicate proxy {} from {}", proxy["name"], source.name)
+                continue
+
+            try:
+                node_name, country = node_name_matches_country(proxy["name"], source.prefix)
+            except ValueError as e:
+                logger.warning(e)
+                continue
+
+            servers.add(server)
+            node_name = node_name.replace("中继", "中转")
+            node_name = node_name.replace("AIA", "腾讯内网")
+            node_name = unique_name(node_name, names)
+            names.add(node_name)
+            proxy["name"] = node_name
+            nodes.append((proxy, country))
+
+    return nodes
+
+
+async def probe_nodes(nodes: List[Tuple[dict, str]]) -> List[Tuple[dict, str]]:
+    """探测节点是否可达，不可达的节点按 setting.probe.action 剔除或排到末尾"""
+    latencies = await probe_proxies((proxy["server"], proxy["port"]) for proxy, _ in nodes)
+    reachable, unreachable = [], []
+    for proxy, country in nodes:
+        if latencies.get((proxy["server"], proxy["port"])) is None:
+            logger.info("proxy {} is unreachable", proxy["name"])
+            unreachable.append((proxy, country))
+        else:
+            reachable.append((proxy, country))
+
+    if setting.probe.action == ProbeAction.demote:
+        return reachable + unreachable
+    return reachable
+
+
+async def get_clash_proxies(subscriptions: List[Tuple[Subscription, Response]]) -> Proxies:
     proxy_names = []
     proxy_names_of_high_speed_special_line = []
     proxy_names_of_hk_node = []
@@ -123,28 +335,14 @@ async def get_clash_proxies() -> Proxies:
     proxy_names_of_kr_node = []
     proxy_names_of_tw_node = []
 
-    rsp = await get(setting.clash)
-    assert rsp.ok, f"clash 订阅获取失败, {rsp.status_code}"
-
-    rdb = redis.client()
-    user_info = rsp.headers.get("subscription-userinfo")
-    if user_info is not None:
-        logger.info("subscription user info: {}", user_info)
-        await rdb.set("subscription:user:info", user_info, ex=timedelta(hours=1))
+    nodes = await merge_nodes(subscriptions)
+    if setting.probe.enable:
+        nodes = await probe_nodes(nodes)
 
     result: List[dict] = []
-    proxies: List[dict] = yaml.safe_load(rsp.text).get("proxies", [])
-    for proxy in proxies:
-        try:
-            node_name, country = node_name_matches_country(proxy["name"])
-        except ValueError as e:
-            logger.warning(e)
-            continue
-
+    for proxy, country in nodes:
+        node_name = proxy["name"]
         result.append(proxy)
-        node_name = node_name.replace("中继", "中转")
-        node_name = node_name.replace("AIA", "腾讯内网")
-        proxy["name"] = node_name
         proxy_names.append(node_name)
         if country == "HK":
             if "专线" in node_name or "腾讯内网" in node_name:
@@ -174,11 +372,103 @@ async def get_clash_proxies() -> Proxies:
     )
 
 
+async def rank_proxy_groups(clash: dict, proxies: Proxies):
+    """按节点的历史延迟与丢包排序 setting.probe.rank 中的分组，并只保留前 N 个节点"""
+    rank = setting.probe.rank
+    if not rank:
+        return
+
+    targets = {proxy["name"]: (proxy["server"], proxy["port"]) for proxy in proxies.proxies}
+    scores = await load_scores(set(targets.values()))
+    for group in clash["proxy-groups"]:
+        top = rank.get(group["name"])
+        if top is None:
+            continue
+
+        others = [name for name in group["proxies"] if name not in targets]
+        nodes = sorted(
+            (name for name in group["proxies"] if name in targets), key=lambda name: scores.get(targets[name], inf)
+        )
+        group["proxies"] = others + (nodes[:top] if top else nodes)
+
+
+async def publish_subscription(artifacts: Dict[str, Artifact], user_info: Optional[str], fingerprint: str) -> int:
+    """在同一个 MULTI/EXEC 中写入新版本的全部 key 并切换 current 指针，读者不会看到不匹配的订阅与流量信息"""
+    rdb, ttl = redis.client(), subscription_ttl()
+    version = await rdb.incr(SUBSCRIPTION_VERSION_KEY)
+    async with rdb.pipeline(transaction=True) as pipe:
+        # 多实例部署时确认仍是 leader，失去租约的旧 leader 不会覆盖新 leader 发布的订阅
+        await fence(pipe)
+        for artifact in artifacts.values():
+            key = ARTIFACT_KEY.format(version, artifact.name)
+            pipe.hset(key, mapping=artifact.dumps()).expire(key, ttl)
+        if user_info is not None:
+            pipe.set(ARTIFACT_KEY.format(version, ARTIFACT_USER_INFO), user_info, ex=ttl)
+            pipe.set(USER_INFO_KEY, user_info, ex=ttl)
+        # 外部服务在每次客户端拉取时直接读取该 key，只有开启 compress_public 时才压缩
+        pipe.set(SUBSCRIPTION_KEY, redis.encode(artifacts["clash"].body, public=True), ex=ttl)
+        pipe.set(SUBSCRIPTION_FINGERPRINT_KEY, fingerprint, ex=ttl)
+        pipe.set(ARTIFACT_CURRENT_KEY, version, ex=ttl)
+        await pipe.publish(SUBSCRIPTION_CHANNEL, version).execute()
+    return version
+
+
+async def extend_subscription(user_info: Optional[str]):
+    """订阅内容未变化时只延长当前版本的过期时间，不发布新版本
+
+    流量信息会变化但订阅内容不变，为它发布新版本需要重新渲染与压缩全部订阅，
+    因此当前版本的 user-info 是唯一会原地更新的版本 key，读取方（components.server）每次都会重新读取
+    """
+    rdb, ttl = redis.client(), subscription_ttl()
+    version = await rdb.get(ARTIFACT_CURRENT_KEY)
+    keys = [SUBSCRIPTION_KEY, SUBSCRIPTION_FINGERPRINT_KEY, ARTIFACT_CURRENT_KEY, USER_INFO_KEY]
+    if version is not None:
+        keys.extend(ARTIFACT_KEY.format(version.decode(), name) for name in (*ARTIFACT_NAMES, ARTIFACT_USER_INFO))
+    async with rdb.pipeline(transaction=True) as pipe:
+        await fence(pipe)
+        for key in keys:
+            pipe.expire(key, ttl)
+        if user_info is not None:
+            if version is not None:
+                pipe.set(ARTIFACT_KEY.format(version.decode(), ARTIFACT_USER_INFO), user_info, ex=ttl)
+            pipe.set(USER_INFO_KEY, user_info, ex=ttl)
+        await pipe.execute()
+
+
+def settings_digest() -> str:
+    """影响订阅内容的配置（订阅源的 prefix / weight、节点探测与排序）的指纹，修改配置后需要重新生成订阅"""
+    content = "\n".join([*(source.json() for source in setting.subscriptions), setting.probe.json()])
+    return digest(content.encode())
+
+
 @monitor
 async def refresh_clash_subscription():
     logger.info("start refreshing the subscription of clash")
-    proxies = await get_clash_proxies()
-    clash = await async_load_yaml_config("../config/clash.yaml")
+    subscriptions = await get_clash_subscriptions()
+    await clash_template.refresh()
+
+    # 订阅内容、模板与相关配置的指纹，都未变化时无需重新生成订阅
+    rdb = redis.client()
+    upstream = ":".join(digest(rsp.content) for _, rsp in subscriptions)
+    fingerprints = [upstream, clash_template.digest, settings_digest()]
+    if setting.probe.enable:
+        # 探测结果过期前订阅内容不会因为节点存活状态而变化
+        fingerprints.append(str(int(time() // setting.probe.cache_ttl)))
+    current = "/".join(fingerprints)
+    previous = (await rdb.get(SUBSCRIPTION_FINGERPRINT_KEY) or b"").decode()
+    # 轮询间隔只看上游订阅是否变化，模板、配置与探测周期的变化不代表上游更新更频繁，
+    # 没有上次的指纹（首次运行或已过期）时无法判断，保持当前间隔
+    changed = previous.split("/", 1)[0] != upstream if previous else None
+    user_info = get_user_info(subscriptions)
+    hint = get_poll_hint(subscriptions)
+    if previous == current and await rdb.exists(ARTIFACT_CURRENT_KEY):
+        await extend_subscription(user_info)
+        logger.info("clash subscription unchanged, extend ttl only")
+        polling.reschedule(changed=False, hint=hint)
+        return
+
+    proxies = await get_clash_proxies(subscriptions)
+    clash = await clash_template.load()
 
     clash["proxies"] = proxies.proxies
     clash["proxy-groups"][1]["proxies"].extend(proxies.proxy_names)
@@ -192,16 +482,19 @@ async def refresh_clash_subscription():
     clash["proxy-groups"][27]["proxies"].extend(proxies.proxy_names_of_us_node)
     clash["proxy-groups"][28]["proxies"].extend(proxies.proxy_names_of_jp_node)
     clash["proxy-groups"][29]["proxies"].extend(proxies.proxy_names_of_kr_node)
+    await rank_proxy_groups(clash, proxies)
 
-    clash_yaml = yaml.safe_dump(clash, allow_unicode=True, width=800, sort_keys=False)
-    rdb = redis.client()
-    await rdb.set("subscription:clash", clash_yaml, ex=timedelta(hours=1))
-    logger.info("refresh clash subscription successful")
+    artifacts = await run(render_artifacts, clash)
+    version = await publish_subscription(artifacts, user_info, current)
+    logger.info("refresh clash subscription successful, version: {}", version)
+    polling.reschedule(changed=changed, hint=hint)
 
 
 if __name__ == "__main__":
     loop = asyncio.get_event_loop()
     loop.run_until_complete(redis.register_redis())
     loop.run_until_complete(register_requests())
+    loop.run_until_complete(register_executor())
     loop.run_until_complete(refresh_clash_subscription())
+    loop.run_until_complete(close_executor())
     loop.run_until_complete(close_requests())
@@ -1,6 +1,7 @@
 from enum import unique
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel, HttpUrl
+from pydantic import BaseModel, Field, HttpUrl, validator
 
 from components.config import load_yaml_config
 from components.enum import StrEnum
@@ -13,16 +14,32 @@ class Mode(StrEnum):
     release = "release"
 
 
+@unique
+class ConverterMode(StrEnum):
+    local = "local"
+    remote = "remote"
+
+
 class Subconverter(BaseModel):
     host: HttpUrl
     url: HttpUrl
     config: HttpUrl
+    mode: ConverterMode = Field(
+        ConverterMode.remote, description="local 在本地转换规则，失败或某个来源没有转换出规则时回退到远程 subconverter"
+    )
+    cache_dir: str = Field("cache/subconverter", description="本地转换时规则来源的缓存目录，相对路径基于项目根目录")
 
 
 class Redis(BaseModel):
     host: str
     port: int
     password: str
+    compress: bool = Field(True, description="较大的值压缩后写入 Redis，优先使用 zstd，未安装时使用 zlib")
+    compress_threshold: int = Field(4096, description="超过该字节数的值才压缩")
+    compress_level: Optional[int] = Field(None, description="压缩等级，为空时使用算法的默认值")
+    compress_public: bool = Field(
+        False, description="subscription:clash、rule-provider 等外部服务直接读取的 key 也压缩，需要读取方先支持解压"
+    )
 
 
 class Monitor(BaseModel):
@@ -35,13 +52,153 @@ class Account(BaseModel):
     password: str
 
 
+@unique
+class ExecutorKind(StrEnum):
+    thread = "thread"
+    process = "process"
+
+
+class Executor(BaseModel):
+    kind: ExecutorKind = Field(ExecutorKind.thread, description="codec 执行器类型，线程池或进程池")
+    workers: Optional[int] = Field(None, description="执行器的 worker 数量，为空时使用默认值")
+
+
+@unique
+class ProbeAction(StrEnum):
+    drop = "drop"
+    demote = "demote"
+
+
+class Probe(BaseModel):
+    enable: bool = Field(False, description="发布订阅前探测节点是否可达")
+    tls: bool = Field(False, description="除 TCP 连接外再完成一次 TLS 握手")
+    concurrency: int = Field(64, description="同时进行的探测数上限")
+    timeout: float = Field(3, description="单个节点的探测超时，单位秒")
+    deadline: float = Field(30, description="整个探测阶段的截止时间，单位秒")
+    cache_ttl: int = Field(900, description="探测结果在 Redis 中的缓存时间，单位秒")
+    action: ProbeAction = Field(ProbeAction.drop, description="不可达节点的处理方式，剔除或排到分组末尾")
+    history_size: int = Field(16, description="每个节点保留的最近探测样本数")
+    loss_penalty: float = Field(4, description="丢包率对节点分数的惩罚系数")
+    rank: Dict[str, int] = Field({}, description="按历史分数排序的分组名及保留的节点数，0 表示只排序不截断")
+
+
+@unique
+class RuleProviderStorage(StrEnum):
+    redis = "redis"
+    disk = "disk"
+
+
+class RuleProviders(BaseModel):
+    enable: bool = Field(False, description="把大的规则族拆成 rule-provider，主配置只引用 RULE-SET")
+    base_url: Optional[HttpUrl] = Field(
+        None, description="客户端下载 rule-provider 的地址前缀，实际地址为 {base_url}/{digest}.yaml"
+    )
+    min_rules: int = Field(500, description="连续指向同一策略组的规则达到该数量时才拆分")
+    interval: int = Field(86400, description="客户端刷新 rule-provider 的间隔，单位秒")
+    storage: RuleProviderStorage = Field(RuleProviderStorage.redis, description="rule-provider 内容的存储位置")
+    directory: str = Field("rule-providers", description="storage 为 disk 时的存储目录，相对路径基于项目根目录")
+
+    @validator("base_url", always=True)
+    def require_base_url(cls, base_url: Optional[HttpUrl], values: dict) -> Optional[HttpUrl]:
+        if values.get("enable") and base_url is None:
+            raise ValueError("开启 rule_providers 时必须配置 base_url")
+        return base_url
+
+
+class Requests(BaseModel):
+    sessions: int = Field(1, description="启动时创建的 ClientSession 数量，请求按轮询复用")
+    limit: int = Field(100, description="连接池总连接数上限")
+    limit_per_host: int = Field(3, description="单个 host 的连接数上限")
+    keepalive_timeout: float = Field(15, description="空闲连接保活时间，单位秒")
+    timeout: float = Field(30, description="单次请求总超时，单位秒")
+    connect_timeout: Optional[float] = Field(None, description="建立连接超时，单位秒")
+    max_body_size: Optional[int] = Field(64 * 1024 * 1024, description="响应 body 最大字节数，为空时不限制")
+    chunk_size: int = Field(64 * 1024, description="流式读取 body 的块大小")
+    http_cache_ttl: int = Field(30 * 24 * 3600, description="HTTP 条件请求缓存在 Redis 中的保存时间，单位秒")
+    breaker_threshold: int = Field(5, description="同一 host 连续失败达到该次数后熔断，0 表示不熔断")
+    breaker_timeout: float = Field(60, description="熔断后经过该时间放行探测请求，单位秒")
+    breaker_half_open_calls: int = Field(1, description="半开状态下同时放行的探测请求数")
+
+
+class Server(BaseModel):
+    enable: bool = Field(False, description="在调度器的事件循环中启动订阅的 HTTP 服务")
+    host: str = Field("0.0.0.0", description="监听地址")
+    port: int = Field(8080, description="监听端口")
+    token: Optional[str] = Field(None, description="访问订阅需要携带的 token 参数，为空时不校验")
+    reload_interval: float = Field(30, description="未收到发布通知时检查 Redis 中订阅版本是否变化的间隔，单位秒")
+
+
+class Leader(BaseModel):
+    enable: bool = Field(False, description="多实例部署时通过 Redis 租约选出 leader，只有 leader 运行定时任务")
+    key: str = Field("e-schedule:leader", description="租约的 key，写入时 WATCH 该 key 实现 fencing")
+    lease: float = Field(30, description="租约时长，单位秒，leader 宕机后 standby 最多在该时间后接管")
+
+
+@unique
+class JobStore(StrEnum):
+    memory = "memory"
+    redis = "redis"
+
+
+class Scheduler(BaseModel):
+    jobstore: JobStore = Field(JobStore.redis, description="任务的存储位置，redis 在重启后保留上次与下次运行时间")
+    jobs_key: str = Field("e-schedule:jobs", description="jobstore 为 redis 时保存任务的 key")
+    run_times_key: str = Field("e-schedule:run_times", description="jobstore 为 redis 时保存下次运行时间的 key")
+    socket_timeout: float = Field(
+        2, description="jobstore 为 redis 时同步客户端的连接与读写超时，单位秒，超时期间事件循环会被阻塞"
+    )
+    misfire_grace_time: Optional[int] = Field(
+        None, description="错过运行时间后仍然补跑的宽限时间，单位秒，为空时不限，配合 coalesce 只补跑一次"
+    )
+    coalesce: bool = Field(True, description="错过多次运行时只补跑一次")
+    max_instances: int = Field(1, description="同一任务同时运行的实例数上限")
+    chain_delay: float = Field(5, description="上游任务成功后触发下游任务的延迟，单位秒，延迟内的重复触发合并为一次")
+
+
+class Polling(BaseModel):
+    enable: bool = Field(True, description="根据订阅内容是否变化调整刷新订阅的间隔")
+    min_interval: float = Field(120, description="订阅内容变化后的刷新间隔，单位秒")
+    max_interval: float = Field(3600, description="订阅内容持续未变化时退避的间隔上限，单位秒")
+    factor: float = Field(2, description="订阅内容未变化时间隔的增长倍数")
+    max_hint: float = Field(
+        3600,
+        description="上游通过 Retry-After / Cache-Control 要求的间隔上限，单位秒，订阅的过期时间取该值与 max_interval 中较大者的两倍",
+    )
+
+
+class Subscription(BaseModel):
+    name: str
+    url: HttpUrl
+    weight: int = Field(0, description="节点重复时保留 weight 更高的订阅源中的节点")
+    prefix: str = Field("", description="节点名前缀，用于区分不同订阅源")
+    timeout: Optional[float] = Field(None, description="请求超时，单位秒，为空时使用 requests.timeout")
+
+
 class Setting(BaseModel):
     mode: Mode
-    clash: HttpUrl
+    clash: Optional[HttpUrl] = Field(None, description="单个订阅源的简写，等价于只有一项的 subscriptions")
+    subscriptions: List[Subscription] = []
+    subscription_concurrency: int = Field(4, description="同时获取的订阅源数量上限")
+    polling: Polling = Polling()
     account: Account
     subconverter: Subconverter
     redis: Redis
     monitor: Monitor
+    requests: Requests = Requests()
+    executor: Executor = Executor()
+    probe: Probe = Probe()
+    rule_providers: RuleProviders = RuleProviders()
+    server: Server = Server()
+    leader: Leader = Leader()
+    scheduler: Scheduler = Scheduler()
+
+    @validator("subscriptions", always=True)
+    def default_subscriptions(cls, subscriptions: List[Subscription], values: dict) -> List[Subscription]:
+        if not subscriptions and values.get("clash") is not None:
+            subscriptions = [Subscription(name="default", url=values["clash"])]
+        if not subscriptions:
+            raise ValueError("clash 与 subscriptions 至少配置一项")
+        return subscriptions
 
 
 def register_setting() -> Setting:
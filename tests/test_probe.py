@@ -0,0 +1,43 @@
+import socket
+from asyncio import start_server
+from unittest import IsolatedAsyncioTestCase
+
+from components.probe import probe, probe_all
+
+
+def closed_port() -> int:
+    """绑定后立即关闭，得到一个没有监听者的本地端口"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class TestProbe(IsolatedAsyncioTestCase):
+    """用本地的监听端口与已关闭的端口代替代理节点"""
+
+    async def asyncSetUp(self):
+        self.server = await start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def asyncTearDown(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def test_reachable(self):
+        latency = await probe("127.0.0.1", self.port, timeout=1)
+        self.assertIsNotNone(latency)
+        self.assertGreaterEqual(latency, 0)
+
+    async def test_closed_port(self):
+        self.assertIsNone(await probe("127.0.0.1", closed_port(), timeout=1))
+
+    async def test_malformed_target(self):
+        self.assertIsNone(await probe(f"{'a' * 70}.example.com", 443, timeout=1))
+        self.assertIsNone(await probe("127.0.0.1", "not-a-port", timeout=1))
+
+    async def test_probe_all(self):
+        reachable, unreachable, malformed = ("127.0.0.1", self.port), ("127.0.0.1", closed_port()), ("a" * 70, 443)
+        results = await probe_all([reachable, unreachable, malformed], concurrency=2, timeout=1, deadline=5)
+        self.assertIsNotNone(results[reachable])
+        self.assertIsNone(results[unreachable])
+        self.assertIsNone(results[malformed])
@@ -0,0 +1,43 @@
+from os import path
+from unittest import TestCase
+
+from components.subconverter import CLASH_DOMAIN, CLASH_IPCIDR, CLASSICAL, build_rules, parse_rulesets
+
+FIXTURES = path.join(path.dirname(__file__), "fixtures", "subconverter")
+BASE_URL = "https://example.com/config/config.ini"
+
+
+def read_fixture(name: str) -> bytes:
+    with open(path.join(FIXTURES, name), "rb") as file:
+        return file.read()
+
+
+class TestSubconverter(TestCase):
+    """用固定的 ini 与规则列表检查本地转换的结果
+
+    expected_rules.txt 按 subconverter 的转换规则手工编写，并非从远程 subconverter 采集，
+    这里不能证明与远程一致，切换到 local 前需要用 refresh_clash_config 的 compare_rules 对照真实的 subconverter
+    """
+
+    def setUp(self):
+        self.rulesets = parse_rulesets(read_fixture("config.ini").decode("utf-8"), BASE_URL)
+        self.bodies = {
+            source: read_fixture(source[len(path.dirname(BASE_URL)) + 1 :])
+            for _, _, source in self.rulesets
+            if source.startswith("https://")
+        }
+
+    def test_parse_rulesets(self):
+        self.assertEqual(self.rulesets[1], ("🛑 广告拦截", CLASSICAL, "https://example.com/config/rules/BanAD.list"))
+        self.assertEqual(self.rulesets[2], ("🚀 节点选择", CLASH_DOMAIN, "https://example.com/config/rules/proxy.yaml"))
+        self.assertEqual(self.rulesets[4][1], CLASH_IPCIDR)
+        self.assertEqual(self.rulesets[6], ("🎯 全球直连", CLASSICAL, "[]GEOIP,CN"))
+
+    def test_expected_rules(self):
+        expected = read_fixture("expected_rules.txt").decode("utf-8").splitlines()
+        self.assertEqual(build_rules(self.rulesets, self.bodies), expected)
+
+    def test_empty_source(self):
+        source = "https://example.com/config/rules/BanAD.list"
+        with self.assertRaises(ValueError):
+            build_rules([("🛑 广告拦截", CLASSICAL, source)], {source: b"USER-AGENT,AdBlock*\n"})